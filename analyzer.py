@@ -1,12 +1,26 @@
 #!/usr/bin/env python3
 
-import datetime
+import gc
 import logging
-import json
+import multiprocessing
+import threading
+from pathlib import Path
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from typing import (Optional, List, Dict,)
 from kanachan_reviewer.config import get_config
 from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.reviews import (
+    UNSUPPORTED_ERROR_CODE, ReviewToPut, get_in_flight_key, put_reviews, get_review_metadata,
+    scan_review_metadata,)
 import kanachan_reviewer.logging as logging_
-from kanachan_reviewer.mahjongsoul_pb2 import Wrapper, ResGameRecord
+from kanachan_reviewer.mahjongsoul_pb2 import ResGameRecord
+from kanachan_reviewer.game_record import (decode_game_records, verify_protobuf_implementation,)
+from kanachan_reviewer.archive import Archive
+from kanachan_reviewer.priority_lanes import PriorityLanes
+from kanachan_reviewer.review_engine import ReviewEngine
+from kanachan_reviewer.review_checkpoints import (
+    get_checkpoints, put_checkpoint, delete_checkpoints,)
 
 
 _CONFIG = get_config()
@@ -19,41 +33,462 @@ assert isinstance(_REDIS_PORT, int)
 _REDIS = Redis(_REDIS_HOST, _REDIS_PORT)
 
 
-def _analyze(game_record: ResGameRecord) -> object:
-    return {}
+_ARCHIVE_PATH = _CONFIG['archive']['path']
+assert isinstance(_ARCHIVE_PATH, str)
+_ARCHIVE = Archive(Path(_ARCHIVE_PATH))
+
+
+_BATCH_SIZE: int = _CONFIG['analyzer']['batch_size'] if 'analyzer' in _CONFIG else 1 # type: ignore
+
+
+_NUM_WORKERS: int = _CONFIG['analyzer']['workers'] if 'analyzer' in _CONFIG else 1 # type: ignore
+
+
+_BULK_PERIOD: int = _CONFIG['analyzer']['bulk_period'] if 'analyzer' in _CONFIG else 8 # type: ignore
+
+
+_RE_REVIEW_INTERVAL: int = 60
+_RE_REVIEW_MAX_REQUESTS: int = 64
+if 'analyzer' in _CONFIG:
+    _RE_REVIEW_INTERVAL = int(_CONFIG['analyzer']['re_review']['interval']) # type: ignore
+    _RE_REVIEW_MAX_REQUESTS = int(_CONFIG['analyzer']['re_review']['max_requests']) # type: ignore
+
+
+_ENGINE: Optional[ReviewEngine] = None
+
+
+def _initialize_engine() -> None:
+    global _ENGINE # pylint: disable=global-statement
+    if _ENGINE is not None:
+        return
+    if 'analyzer' not in _CONFIG or 'model' not in _CONFIG['analyzer']:
+        logging.warning('No model is configured.')
+        return
+
+    model_config = _CONFIG['analyzer']['model']
+    assert isinstance(model_config, dict)
+    model_path = model_config['path']
+    assert isinstance(model_path, str)
+    model_batch_size = model_config['batch_size']
+    assert isinstance(model_batch_size, int)
+    model_threads = model_config['threads']
+    assert isinstance(model_threads, int)
+    _ENGINE = ReviewEngine(model_path, model_batch_size, model_threads)
+    logging.info('%s: Loaded the model.', model_path)
+
+
+# Game records are queued in either the interactive lane, for those requested
+# by users, or the bulk lane, for re-reviews and backfills. The bulk lane gets
+# a share of the batches only as `_BULK_PERIOD` dictates while interactive
+# game records are waiting.
+#
+# Game records are moved from each lane to the processing list of the analyzer
+# process that takes them for that lane, and are removed from there only after
+# their reviews are stored. While the process is alive, it keeps its heartbeat key alive and
+# its rank registered, so that the processing lists of dead processes can be
+# told apart and their game records can be put back to the queue.
+#
+# Each time a game record is put back, its attempt count is incremented. A game
+# record that has been put back is analyzed alone, so that it does not drag
+# the other game records of a batch down with it, and one that has been put
+# back `_MAX_ATTEMPTS` times is moved to the dead-letter list instead, so that
+# a game record that keeps crashing the analysis does not keep the workers
+# busy forever.
+_INTERACTIVE_QUEUE_KEY = 'game-records'
+_BULK_QUEUE_KEY = 'game-records.bulk'
+_IDLE_POLL_INTERVAL = 1
+_INTERACTIVE_PROCESSING_KEY_PREFIX = 'game-records.processing.'
+_BULK_PROCESSING_KEY_PREFIX = 'game-records.bulk.processing.'
+_PROCESS_RANKS_KEY = 'analyzer-process-ranks'
+_HEARTBEAT_KEY_PREFIX = 'analyzer-heartbeats.'
+_HEARTBEAT_TTL = 60
+_HEARTBEAT_INTERVAL = 20
+_ATTEMPTS_KEY = 'game-records.attempts'
+_DEAD_LETTER_KEY = 'game-records.dead-letter'
+_MAX_ATTEMPTS = 3
+
+
+def _get_entry_name(entry: bytes) -> str:
+    if entry.startswith(b'\x03'):
+        return 'A legacy entry'
+    return entry.decode('UTF-8')
+
+
+# Returns the processing list of each lane of an analyzer process.
+def _get_processing_keys(process_rank: str) -> Dict[str, str]:
+    return {
+        _INTERACTIVE_QUEUE_KEY: f'{_INTERACTIVE_PROCESSING_KEY_PREFIX}{process_rank}',
+        _BULK_QUEUE_KEY: f'{_BULK_PROCESSING_KEY_PREFIX}{process_rank}'
+    }
+
+
+def _requeue_lane(queue_key: str, processing_key: str) -> None:
+    entries = _REDIS.lrange(processing_key, 0, -1)
+    if len(entries) == 0:
+        return
+
+    pipeline = _REDIS.pipeline(transaction=False)
+    for entry in entries:
+        pipeline.hincrby(_ATTEMPTS_KEY, entry)
+    attempts = pipeline.execute()
+
+    # Push back to the tail of the lane, so that a game record that keeps
+    # failing does not starve the others.
+    pipeline = _REDIS.pipeline()
+    num_dead = 0
+    for entry, num_attempts in zip(entries, attempts):
+        assert isinstance(num_attempts, int)
+        if num_attempts >= _MAX_ATTEMPTS:
+            logging.error(
+                '%s: Gave up the analysis after %d attempts.', _get_entry_name(entry),
+                num_attempts)
+            pipeline.lmove(processing_key, _DEAD_LETTER_KEY)
+            pipeline.hdel(_ATTEMPTS_KEY, entry)
+            if not entry.startswith(b'\x03'):
+                # Let the next request for the game record start over.
+                pipeline.delete(get_in_flight_key(entry.decode('UTF-8')))
+                pipeline.hdel('game-record-fetched', entry)
+            num_dead += 1
+        else:
+            pipeline.lmove(processing_key, queue_key)
+    pipeline.execute()
+    logging.warning(
+        '%s: Requeued %d game record(s), and dead-lettered %d game record(s).',
+        processing_key, len(entries) - num_dead, num_dead)
+
+
+def _requeue(process_rank: str) -> None:
+    for queue_key, processing_key in _get_processing_keys(process_rank).items():
+        _requeue_lane(queue_key, processing_key)
+
+
+def _requeue_orphans() -> None:
+    for process_rank in _REDIS.smembers(_PROCESS_RANKS_KEY):
+        if _REDIS.exists(f'{_HEARTBEAT_KEY_PREFIX}{process_rank}'):
+            continue
+        # Only the process that unregisters the dead one puts back its game
+        # records.
+        if not _REDIS.srem(_PROCESS_RANKS_KEY, process_rank):
+            continue
+        _requeue(process_rank)
+
+
+def _keep_heartbeat(process_rank: int, stopped: threading.Event) -> None:
+    heartbeat_key = f'{_HEARTBEAT_KEY_PREFIX}{process_rank}'
+    while True:
+        try:
+            # Register the rank only together with the heartbeat, so that no
+            # other process takes the rank for that of a dead process.
+            pipeline = _REDIS.pipeline()
+            pipeline.set(heartbeat_key, '', ex=_HEARTBEAT_TTL)
+            pipeline.sadd(_PROCESS_RANKS_KEY, str(process_rank))
+            pipeline.execute()
+            _requeue_orphans()
+        except: # pylint: disable=bare-except
+            logging.exception('Failed to keep the heartbeat.')
+        if stopped.wait(_HEARTBEAT_INTERVAL):
+            break
+    try:
+        _REDIS.delete(heartbeat_key)
+    except: # pylint: disable=bare-except
+        logging.exception('Failed to delete the heartbeat.')
+
+
+# Stale reviews, those produced by another version of the model or the review
+# format, keep being served while they are re-reviewed in the background. One
+# analyzer process per interval scans a chunk of the reviews, and queues the
+# archived game records of the stale ones to the bulk lane of the analyzer
+# directly. The others are requested through the bulk lane of the fetcher.
+# Both bulk lanes give way to interactive work, so that re-reviews mostly use
+# spare capacity.
+_RE_REVIEW_REQUEST_KEY = 'game-record-requests.bulk'
+_RE_REVIEW_LOCK_KEY = 're-review-lock'
+_RE_REVIEW_CURSOR_KEY = 're-review-cursor'
+_RE_REVIEW_SCAN_COUNT = 1000
+_RE_REVIEW_MAX_SCANS = 16
+
+
+def _is_stale(metadata: Dict[str, object], version: str) -> bool:
+    # Error reviews do not depend on the model.
+    return metadata['error_code'] == 0 and metadata.get('version') != version
+
+
+def _request_re_reviews(version: str) -> None:
+    if not _REDIS.set(_RE_REVIEW_LOCK_KEY, '', nx=True, ex=_RE_REVIEW_INTERVAL):
+        return
+    room = _RE_REVIEW_MAX_REQUESTS - (
+        _REDIS.llen(_BULK_QUEUE_KEY) + _REDIS.llen(_RE_REVIEW_REQUEST_KEY))
+    if room <= 0:
+        return
+
+    encoded_cursor = _REDIS.get(_RE_REVIEW_CURSOR_KEY)
+    cursor = 0 if encoded_cursor is None else int(encoded_cursor)
+    stale_uuids: List[str] = []
+    for _ in range(_RE_REVIEW_MAX_SCANS):
+        cursor, chunk = scan_review_metadata(_REDIS, cursor, _RE_REVIEW_SCAN_COUNT)
+        for uuid, metadata in chunk.items():
+            if _is_stale(metadata, version):
+                stale_uuids.append(uuid)
+        if cursor == 0 or len(stale_uuids) >= room:
+            break
+    _REDIS.set(_RE_REVIEW_CURSOR_KEY, str(cursor))
+
+    # The rest are found again in a later pass of the scan.
+    stale_uuids = stale_uuids[:room]
+    if len(stale_uuids) == 0:
+        return
+    pipeline = _REDIS.pipeline(transaction=False)
+    num_archived = 0
+    for uuid in stale_uuids:
+        if _ARCHIVE.contains(uuid):
+            pipeline.rpush(_BULK_QUEUE_KEY, uuid)
+            num_archived += 1
+        else:
+            pipeline.rpush(_RE_REVIEW_REQUEST_KEY, uuid)
+    pipeline.execute()
+    logging.info(
+        'Requested re-reviews of %d game record(s), %d of which are archived.',
+        len(stale_uuids), num_archived)
+
+
+def _keep_requesting_re_reviews(version: str, stopped: threading.Event) -> None:
+    while True:
+        try:
+            _request_re_reviews(version)
+        except: # pylint: disable=bare-except
+            logging.exception('Failed to request re-reviews.')
+        if stopped.wait(_RE_REVIEW_INTERVAL):
+            break
+
+
+# Loads the game records of the entries of `game-records`. An entry is the uuid
+# of a game record in the archive, or the whole response message captured by
+# the sniffer if it was queued before the archive was introduced.
+def _load_game_records(entries: List[bytes]) -> List[ResGameRecord]:
+    legacy_entries: List[bytes] = []
+    uuids: List[str] = []
+    for entry in entries:
+        if entry.startswith(b'\x03'):
+            legacy_entries.append(entry)
+        else:
+            uuids.append(entry.decode('UTF-8'))
+
+    # Both kinds of entries are decoded or read in one call per batch.
+    legacy_game_records = iter(decode_game_records(legacy_entries))
+    archived = iter(zip(uuids, _ARCHIVE.get_many(uuids)))
+    game_records: List[ResGameRecord] = []
+    for entry in entries:
+        if entry.startswith(b'\x03'):
+            game_records.append(next(legacy_game_records))
+            continue
+        uuid, data = next(archived)
+        if data is None:
+            logging.error('%s: Not found in the archive.', uuid)
+            # Let the next request for the game record fetch it again.
+            pipeline = _REDIS.pipeline(transaction=False)
+            pipeline.delete(get_in_flight_key(uuid))
+            pipeline.hdel('game-record-fetched', uuid)
+            pipeline.execute()
+            continue
+        game_record = ResGameRecord()
+        game_record.ParseFromString(data)
+        game_records.append(game_record)
+    return game_records
+
+
+def _analyze_batch(game_records: List[ResGameRecord]) -> List[Optional[object]]:
+    if _ENGINE is None:
+        return [{} for _ in game_records]
+
+    # Resume from the rounds reviewed before an interruption, and checkpoint
+    # each round as soon as it is reviewed.
+    uuids: List[str] = []
+    for game_record in game_records:
+        uuids.append(game_record.head.uuid) # pylint: disable=no-member
+    version = _ENGINE.get_version()
+    finished_rounds = get_checkpoints(_REDIS, version, uuids)
+    for uuid, rounds in zip(uuids, finished_rounds):
+        if len(rounds) > 0:
+            logging.info('%s: Resume from %d reviewed round(s).', uuid, len(rounds))
+
+    def on_round_reviewed(i: int, round_index: int, round_review: object) -> None:
+        put_checkpoint(_REDIS, version, uuids[i], round_index, round_review)
+
+    return _ENGINE.review(game_records, finished_rounds, on_round_reviewed)
+
+
+# Moves a batch of entries from the lanes to the processing lists. The first
+# entry is taken as `lanes` dictates, blocking until any arrives, and the rest
+# of the batch is filled up with the ones that have already been queued,
+# interactive ones first. An entry that has been put back is taken alone.
+def _take_batch(lanes: PriorityLanes, processing_keys: Dict[str, str]) -> List[bytes]:
+    while True:
+        entry: Optional[bytes] = None
+        for key in lanes.get_keys():
+            entry = _REDIS.lmove(key, processing_keys[key])
+            if entry is not None:
+                break
+        if entry is not None:
+            break
+        # Both lanes are empty. Block on the interactive lane for a while, and
+        # then look at the bulk lane again.
+        key = _INTERACTIVE_QUEUE_KEY
+        entry = _REDIS.blmove(key, processing_keys[key], _IDLE_POLL_INTERVAL)
+        if entry is not None:
+            break
+    lanes.on_pop(key)
+    assert entry is not None
+    batch = [entry]
+    if _REDIS.hget(_ATTEMPTS_KEY, entry) is not None:
+        return batch
+
+    for key in (_INTERACTIVE_QUEUE_KEY, _BULK_QUEUE_KEY):
+        if len(batch) >= _BATCH_SIZE:
+            break
+        pipeline = _REDIS.pipeline(transaction=False)
+        for _ in range(_BATCH_SIZE - len(batch)):
+            pipeline.lmove(key, processing_keys[key])
+        entries: List[bytes] = []
+        for result in pipeline.execute():
+            if result is None:
+                break
+            assert isinstance(result, bytes)
+            entries.append(result)
+        if len(entries) == 0:
+            continue
+
+        # Put the entries that have been put back before to the tail of the
+        # lane again, so that each of them is eventually taken alone.
+        pipeline = _REDIS.pipeline(transaction=False)
+        for entry in entries:
+            pipeline.hget(_ATTEMPTS_KEY, entry)
+        attempts = pipeline.execute()
+        pipeline = _REDIS.pipeline()
+        for entry, num_attempts in zip(entries, attempts):
+            if num_attempts is None:
+                batch.append(entry)
+                continue
+            pipeline.lrem(processing_keys[key], 1, entry)
+            pipeline.rpush(key, entry)
+        pipeline.execute()
+
+    return batch
 
 
 def _main() -> None:
     process_rank = _REDIS.postincr('analyzer-process-rank')
     logging_.initialize('analyzer', process_rank, _REDIS, _CONFIG)
+    verify_protobuf_implementation()
+    _initialize_engine()
 
-    while True:
-        wrapped_data = _REDIS.blpop('game-records')
-        assert isinstance(wrapped_data, bytes)
-        wrapper = Wrapper()
-        wrapper.ParseFromString(wrapped_data[3:])
-        assert wrapper.name == '' # pylint: disable=no-member
+    processing_keys = _get_processing_keys(str(process_rank))
+    lanes = PriorityLanes(_INTERACTIVE_QUEUE_KEY, _BULK_QUEUE_KEY, _BULK_PERIOD)
+    stopped = threading.Event()
+    heartbeat_thread = threading.Thread(
+        target=_keep_heartbeat, args=(process_rank, stopped), daemon=True)
+    heartbeat_thread.start()
+    version = None if _ENGINE is None else _ENGINE.get_version()
+    re_review_thread: Optional[threading.Thread] = None
+    if version is not None:
+        re_review_thread = threading.Thread(
+            target=_keep_requesting_re_reviews, args=(version, stopped), daemon=True)
+        re_review_thread.start()
 
-        game_record = ResGameRecord()
-        game_record.ParseFromString(wrapper.data) # pylint: disable=no-member
-        assert game_record.error.code == 0 # pylint: disable=no-member
-        uuid = game_record.head.uuid # pylint: disable=no-member
-        logging.info('%s: A game record arrived.', uuid)
-
-        review = _analyze(game_record)
-        review_with_timestamp = {
-            'error_code': 0,
-            'review': review,
-            'timestamp': int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-        }
-        review_with_timestamp_json = json.dumps(review_with_timestamp)
-        _REDIS.hsetnx('reviews', uuid, review_with_timestamp_json)
-        logging.info('%s: Completed the review.', uuid)
+    try:
+        while True:
+            batch = _take_batch(lanes, processing_keys)
+            game_records = _load_game_records(batch)
+            uuids: List[str] = []
+            for game_record in game_records:
+                assert game_record.error.code == 0 # pylint: disable=no-member
+                uuid = game_record.head.uuid # pylint: disable=no-member
+                logging.info('%s: A game record arrived.', uuid)
+                uuids.append(uuid)
 
+            # Review only the game records without an up-to-date review.
+            new_indices: List[int] = []
+            stale_indices: List[int] = []
+            for i, metadata in enumerate(get_review_metadata(_REDIS, uuids)):
+                if metadata is None:
+                    new_indices.append(i)
+                elif version is not None and _is_stale(metadata, version):
+                    stale_indices.append(i)
+                else:
+                    logging.info('%s: The review is up to date.', uuids[i])
+            indices = new_indices + stale_indices
+            reviews = _analyze_batch([game_records[i] for i in indices])
+            reviews_to_put: List[ReviewToPut] = []
+            for i, review in zip(indices, reviews):
+                error_code = 0 if review is not None else UNSUPPORTED_ERROR_CODE
+                reviews_to_put.append((uuids[i], error_code, review))
+            put_reviews(
+                _REDIS, reviews_to_put[:len(new_indices)], overwrite=False, version=version)
+            put_reviews(
+                _REDIS, reviews_to_put[len(new_indices):], overwrite=True, version=version)
 
-if __name__ == '__main__':
+            # Acknowledge the batch.
+            if version is not None:
+                delete_checkpoints(_REDIS, version, [uuid for uuid, _, _ in reviews_to_put])
+            pipeline = _REDIS.pipeline()
+            for entry in batch:
+                pipeline.hdel(_ATTEMPTS_KEY, entry)
+            for processing_key in processing_keys.values():
+                pipeline.delete(processing_key)
+            pipeline.execute()
+            for uuid, _, _ in reviews_to_put:
+                logging.info('%s: Completed the review.', uuid)
+    finally:
+        stopped.set()
+        heartbeat_thread.join()
+        if re_review_thread is not None:
+            re_review_thread.join()
+        try:
+            _requeue(str(process_rank))
+            _REDIS.srem(_PROCESS_RANKS_KEY, str(process_rank))
+        except: # pylint: disable=bare-except
+            # The game records are requeued by another process once the
+            # heartbeat expires.
+            logging.exception('%d: Failed to requeue.', process_rank)
+
+
+def _run() -> None:
     while True:
         try:
             _main()
         except: # pylint: disable=bare-except
             logging.exception('Abort with an exception.')
+
+
+# Runs `_NUM_WORKERS` worker processes, and restarts them when they die. The
+# model is loaded once before forking, so that the workers share its weights
+# through copy-on-write pages, which are never written during inference.
+def _supervise() -> None:
+    _initialize_engine()
+    # Keep the garbage collector from touching, and thereby copying, the pages
+    # of the objects inherited from the supervisor.
+    gc.freeze()
+
+    context = multiprocessing.get_context('fork')
+    workers: List[BaseProcess] = []
+    for _ in range(_NUM_WORKERS):
+        worker = context.Process(target=_run, daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    while True:
+        wait([worker.sentinel for worker in workers])
+        for i, worker in enumerate(workers):
+            if worker.is_alive():
+                continue
+            logging.warning('%d: A worker process exited with %s.', worker.pid, worker.exitcode)
+            worker.close()
+            worker = context.Process(target=_run, daemon=True)
+            worker.start()
+            workers[i] = worker
+
+
+if __name__ == '__main__':
+    if _NUM_WORKERS == 1:
+        _run()
+    else:
+        _supervise()
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from http import HTTPStatus
+from typing import (Optional, List, Dict,)
+from quart import (Quart, Response, request,)
+from kanachan_reviewer.config import get_config
+from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.async_redis import (AsyncSubscription, AsyncRedis,)
+from kanachan_reviewer.reviews import (
+    NOTIFICATION_CHANNEL_PATTERN, get_uuid_from_notification_channel,
+    async_get_encoded_review_metadata, async_get_review,)
+from kanachan_reviewer.response_cache import ResponseCache
+from kanachan_reviewer.frontend import (
+    TIMEOUT, is_valid_uuid, create_response_cache, initialize_fetchers, async_request_review,
+    decode_and_cache_review, make_response,)
+
+
+app = Quart(__name__)
+
+
+_CONFIG = get_config()
+
+
+_REDIS_HOST = _CONFIG['redis']['host']
+assert isinstance(_REDIS_HOST, str)
+_REDIS_PORT = _CONFIG['redis']['port']
+assert isinstance(_REDIS_PORT, int)
+_REDIS = AsyncRedis(_REDIS_HOST, _REDIS_PORT)
+
+
+_CACHE = create_response_cache(_CONFIG)
+
+
+initialize_fetchers(Redis(_REDIS_HOST, _REDIS_PORT), _CONFIG)
+
+
+# Dispatches review notifications from a single subscription to the requests
+# waiting for them, so that each pending request costs only a future instead of
+# a thread or a Redis connection. The notifications also invalidate the cached
+# responses.
+class _ReviewWaiters(object):
+    def __init__(self, redis: AsyncRedis, cache: ResponseCache) -> None:
+        self.__redis = redis
+        self.__cache = cache
+        self.__waiters: Dict[str, List[asyncio.Future[bytes]]] = {}
+        self.__subscribed = asyncio.Event()
+
+    async def wait_until_subscribed(self) -> None:
+        await self.__subscribed.wait()
+
+    def add(self, uuid: str) -> asyncio.Future[bytes]:
+        future: asyncio.Future[bytes] = asyncio.get_running_loop().create_future()
+        self.__waiters.setdefault(uuid, []).append(future)
+        return future
+
+    def remove(self, uuid: str, future: asyncio.Future[bytes]) -> None:
+        futures = self.__waiters.get(uuid)
+        if futures is None:
+            return
+        if future in futures:
+            futures.remove(future)
+        if len(futures) == 0:
+            del self.__waiters[uuid]
+
+    def __resolve(self, uuid: str, metadata_encoded: bytes) -> None:
+        futures = self.__waiters.pop(uuid, None)
+        if futures is None:
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(metadata_encoded)
+
+    async def run(self) -> None:
+        while True:
+            subscription: Optional[AsyncSubscription] = None
+            try:
+                subscription = await self.__redis.psubscribe(NOTIFICATION_CHANNEL_PATTERN)
+
+                # Notifications published while not subscribed have been lost,
+                # so look up the reviews for the requests already waiting.
+                self.__cache.clear()
+                for uuid in list(self.__waiters.keys()):
+                    metadata_encoded = await async_get_encoded_review_metadata(
+                        self.__redis, uuid)
+                    if metadata_encoded is not None:
+                        self.__resolve(uuid, metadata_encoded)
+
+                self.__subscribed.set()
+                async for channel, metadata_encoded in subscription.listen():
+                    uuid = get_uuid_from_notification_channel(channel)
+                    self.__cache.invalidate(uuid)
+                    self.__resolve(uuid, metadata_encoded)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Lost the subscription to review notifications.')
+            finally:
+                self.__subscribed.clear()
+                if subscription is not None:
+                    await subscription.close()
+            await asyncio.sleep(1)
+
+
+_WAITERS = _ReviewWaiters(_REDIS, _CACHE)
+
+
+_BACKGROUND_TASKS: List[asyncio.Task[None]] = []
+
+
+@app.before_serving
+async def _start_background_tasks() -> None:
+    _BACKGROUND_TASKS.append(asyncio.create_task(_WAITERS.run()))
+
+
+@app.after_serving
+async def _stop_background_tasks() -> None:
+    for task in _BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*_BACKGROUND_TASKS, return_exceptions=True)
+    _BACKGROUND_TASKS.clear()
+    await _REDIS.close()
+
+
+@app.route('/')
+async def top_page():
+    return Response(status=HTTPStatus.OK)
+
+
+@app.route('/<uuid>')
+async def analyze(uuid: str):
+    if not is_valid_uuid(uuid):
+        return Response(status=HTTPStatus.NOT_FOUND)
+
+    generation = _CACHE.get_generation()
+    cached_response = _CACHE.get(uuid)
+    if cached_response is not None:
+        return make_response(Response, request, cached_response)
+
+    # Serve a cached review without touching the request queue.
+    stored_review = await async_get_review(_REDIS, uuid)
+    if stored_review is not None:
+        logging.info('%s: The review is cached.', uuid)
+        return make_response(
+            Response, request, decode_and_cache_review(_CACHE, uuid, stored_review, generation))
+
+    try:
+        await asyncio.wait_for(_WAITERS.wait_until_subscribed(), TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.error('%s: Not subscribed to review notifications.', uuid)
+        return Response(status=HTTPStatus.SERVICE_UNAVAILABLE)
+
+    # Register the wait before requesting the review so that the notification
+    # cannot be missed.
+    future = _WAITERS.add(uuid)
+    try:
+        await async_request_review(_REDIS, uuid)
+
+        # The review may have been cached before the wait was registered. The
+        # generation is obtained again right before each lookup, since any
+        # review written while waiting invalidates the one obtained before.
+        generation = _CACHE.get_generation()
+        stored_review = await async_get_review(_REDIS, uuid)
+        if stored_review is None:
+            try:
+                await asyncio.wait_for(future, TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                generation = _CACHE.get_generation()
+                stored_review = await async_get_review(_REDIS, uuid)
+        if stored_review is not None:
+            logging.info('%s: The review arrived.', uuid)
+    finally:
+        _WAITERS.remove(uuid, future)
+
+    if stored_review is None:
+        logging.info('%s: The review timed out.', uuid)
+        return Response(status=HTTPStatus.REQUEST_TIMEOUT)
+
+    return make_response(
+        Response, request, decode_and_cache_review(_CACHE, uuid, stored_review, generation))
@@ -3,6 +3,7 @@
 set -euxo pipefail
 
 sudo chown -R ubuntu:ubuntu /var/log/kanachan-reviewer
+sudo chown ubuntu:ubuntu /var/lib/kanachan-reviewer
 sudo rm -rf /srv/kanachan-reviewer/*
 sudo chown ubuntu:ubuntu /srv/kanachan-reviewer
 #pushd monitor
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+import gc
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+import time
+from typing import (Optional, Tuple, Iterable, Iterator, List, TextIO,)
+from kanachan_reviewer.config import get_config
+from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.reviews import (UNSUPPORTED_ERROR_CODE, ReviewToPut, put_reviews,)
+from kanachan_reviewer.mahjongsoul_pb2 import ResGameRecord
+from kanachan_reviewer.game_record import verify_protobuf_implementation
+from kanachan_reviewer.archive import Archive
+from kanachan_reviewer.review_engine import ReviewEngine
+
+
+# Reviews game records offline, reading serialized `ResGameRecord` messages
+# from files, directories, or an archive, and writing the reviews either to
+# the `reviews` hash or to a JSONL file.
+
+
+_ENGINE: Optional[ReviewEngine] = None
+
+
+def _iterate_files(paths: Iterable[Path]) -> Iterator[bytes]:
+    for path in paths:
+        if path.is_dir():
+            yield from _iterate_files(sorted(p for p in path.iterdir()))
+            continue
+        with open(path, 'rb') as fp:
+            yield fp.read()
+
+
+def _iterate_archive(archive: Archive, chunk_size: int) -> Iterator[bytes]:
+    uuids = archive.get_uuids()
+    for begin in range(0, len(uuids), chunk_size):
+        for data in archive.get_many(uuids[begin:begin + chunk_size]):
+            assert data is not None
+            yield data
+
+
+def _iterate_chunks(
+        game_records: Iterator[bytes], chunk_size: int,
+        semaphore: threading.Semaphore) -> Iterator[List[bytes]]:
+    chunk: List[bytes] = []
+    for game_record in game_records:
+        chunk.append(game_record)
+        if len(chunk) == chunk_size:
+            # Block until a result has been consumed, so that only a bounded
+            # number of chunks are read ahead of the workers.
+            semaphore.acquire() # pylint: disable=consider-using-with
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        semaphore.acquire() # pylint: disable=consider-using-with
+        yield chunk
+
+
+# Returns the reviews of the game records in the chunk, and the number of the
+# game records that failed to be parsed or reviewed, which are left out of the
+# reviews so that the rest of the run goes on.
+def _review_chunk(chunk: List[bytes]) -> Tuple[List[Tuple[str, Optional[object]]], int]:
+    game_records: List[ResGameRecord] = []
+    num_failed = 0
+    for data in chunk:
+        game_record = ResGameRecord()
+        try:
+            game_record.ParseFromString(data)
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Failed to parse a game record.')
+            num_failed += 1
+            continue
+        game_records.append(game_record)
+
+    assert _ENGINE is not None
+    results: List[Tuple[str, Optional[object]]] = []
+    try:
+        reviews = _ENGINE.review(game_records)
+    except Exception: # pylint: disable=broad-except
+        # Find out the game records that fail by reviewing them one by one.
+        logging.exception('Failed to review a chunk, which is reviewed game by game.')
+        for game_record in game_records:
+            uuid = game_record.head.uuid # pylint: disable=no-member
+            try:
+                review = _ENGINE.review([game_record])[0]
+            except Exception: # pylint: disable=broad-except
+                logging.exception('%s: Failed to review the game record.', uuid)
+                num_failed += 1
+                continue
+            results.append((uuid, review))
+        return results, num_failed
+
+    for game_record, review in zip(game_records, reviews):
+        results.append((game_record.head.uuid, review)) # pylint: disable=no-member
+    return results, num_failed
+
+
+# The review of a game record that cannot be reviewed is written as `null`.
+def _write_jsonl(fp: TextIO, results: List[Tuple[str, Optional[object]]]) -> None:
+    for uuid, review in results:
+        fp.write(json.dumps({'uuid': uuid, 'review': review}, separators=(',', ':')))
+        fp.write('\n')
+
+
+def _main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    config = get_config()
+    analyzer_config = config['analyzer'] if 'analyzer' in config else {}
+    model_config = analyzer_config['model'] if 'model' in analyzer_config else {}
+    assert isinstance(model_config, dict)
+
+    parser = ArgumentParser(description='Review game records offline.')
+    parser.add_argument(
+        'paths', nargs='*', type=Path,
+        help='files holding serialized `ResGameRecord` messages, or directories of them')
+    parser.add_argument(
+        '--archive', type=Path, help='an archive to review all the game records in')
+    parser.add_argument('--model', default=model_config.get('path'), help='the model file')
+    parser.add_argument(
+        '--model-batch-size', type=int, default=model_config.get('batch_size', 1024),
+        help='the number of decision points evaluated in one forward pass')
+    parser.add_argument(
+        '--threads', type=int, default=model_config.get('threads', 1),
+        help='the number of torch threads per worker process')
+    parser.add_argument(
+        '--workers', type=int, default=os.cpu_count() or 1,
+        help='the number of worker processes')
+    parser.add_argument(
+        '--chunk-size', type=int, default=64,
+        help='the number of game records dispatched to a worker at once')
+    parser.add_argument(
+        '--jsonl', type=Path,
+        help='a JSONL file to write the reviews to instead of the `reviews` hash')
+    parser.add_argument(
+        '--overwrite', action='store_true', help='overwrite existing reviews in the hash')
+    args = parser.parse_args()
+
+    if args.model is None:
+        parser.error('No model is specified.')
+    if len(args.paths) == 0 and args.archive is None:
+        parser.error('No game record is specified.')
+    if args.workers < 1:
+        parser.error(f'{args.workers}: An invalid number of worker processes.')
+    if args.chunk_size < 1:
+        parser.error(f'{args.chunk_size}: An invalid chunk size.')
+
+    verify_protobuf_implementation()
+
+    global _ENGINE # pylint: disable=global-statement
+    _ENGINE = ReviewEngine(args.model, args.model_batch_size, args.threads)
+    version = _ENGINE.get_version()
+
+    game_records: Iterator[bytes] = _iterate_files(args.paths)
+    if args.archive is not None:
+        archive = Archive(args.archive)
+        game_records = itertools.chain(
+            game_records, _iterate_archive(archive, args.chunk_size))
+
+    redis: Optional[Redis] = None
+    jsonl: Optional[TextIO] = None
+    if args.jsonl is None:
+        redis_host = config['redis']['host']
+        assert isinstance(redis_host, str)
+        redis_port = config['redis']['port']
+        assert isinstance(redis_port, int)
+        redis = Redis(redis_host, redis_port)
+    else:
+        jsonl = open(args.jsonl, 'w', encoding='UTF-8') # pylint: disable=consider-using-with
+
+    # The workers inherit the model loaded above, sharing its weights.
+    gc.freeze()
+    semaphore = threading.Semaphore(args.workers * 2)
+    chunks = _iterate_chunks(game_records, args.chunk_size, semaphore)
+
+    num_reviewed = 0
+    num_failed = 0
+    start_time = time.monotonic()
+    last_report_time = start_time
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(args.workers) as pool:
+            for results, num_chunk_failed in pool.imap_unordered(_review_chunk, chunks):
+                semaphore.release()
+                if redis is not None:
+                    reviews_to_put: List[ReviewToPut] = [
+                        (uuid, 0 if review is not None else UNSUPPORTED_ERROR_CODE, review)
+                        for uuid, review in results]
+                    put_reviews(redis, reviews_to_put, overwrite=args.overwrite, version=version)
+                else:
+                    assert jsonl is not None
+                    _write_jsonl(jsonl, results)
+
+                num_reviewed += len(results)
+                num_failed += num_chunk_failed
+                now = time.monotonic()
+                if now - last_report_time >= 10.0:
+                    logging.info(
+                        '%d game records reviewed, %.2f records/sec.', num_reviewed,
+                        num_reviewed / (now - start_time))
+                    last_report_time = now
+    finally:
+        if jsonl is not None:
+            jsonl.close()
+
+    elapsed_time = time.monotonic() - start_time
+    logging.info(
+        '%d game records reviewed in %.2f sec, %.2f records/sec.', num_reviewed, elapsed_time,
+        num_reviewed / elapsed_time if elapsed_time > 0.0 else 0.0)
+    if num_failed > 0:
+        logging.warning('%d game records failed to be reviewed.', num_failed)
+
+
+if __name__ == '__main__':
+    _main()
@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
 import datetime
+import io
+import math
 import random
 import pathlib
+import queue
+import threading
 import time
 import logging
 import json
-from typing import Dict
+from typing import (Optional, Tuple, List, Dict,)
 import sys
+from PIL import (Image, ImageChops,)
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.proxy import Proxy
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
@@ -20,7 +25,9 @@ from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver import ActionChains
 from kanachan_reviewer.config import get_config
+from kanachan_reviewer.priority_lanes import PriorityLanes
 from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.reviews import get_in_flight_key
 import kanachan_reviewer.logging as logging_
 from kanachan_reviewer.yostar_login import YostarLogin
 
@@ -38,6 +45,46 @@ _REDIS = Redis(_REDIS_HOST, _REDIS_PORT)
 _BROWSER_RESTART_INTERVAL = 60
 
 
+# The maximum time to wait for the game UI to react to a click or a key input.
+_UI_TIMEOUT = 5.0
+
+
+# The canvas is regarded as changed between two screenshots if more than this
+# fraction of its pixels differ noticeably. The lobby keeps animating, so the
+# canvas never stops changing completely.
+_CANVAS_CHANGE_RATIO = 0.02
+_CANVAS_PIXEL_THRESHOLD = 32
+
+
+_FETCH_TIMEOUT = 60
+
+
+# The maximum number of game records fetched concurrently. Only the `lobby`
+# method fetches more than one at a time.
+_MAX_IN_FLIGHT: int = _CONFIG['fetcher']['max_in_flight'] if 'fetcher' in _CONFIG else 1 # type: ignore
+
+
+_FETCH_METHOD: str = _CONFIG['fetcher']['method'] if 'fetcher' in _CONFIG else 'navigate' # type: ignore
+
+
+_NUM_STANDBY_SESSIONS: int = (
+    _CONFIG['fetcher']['standby_sessions'] if 'fetcher' in _CONFIG else 0) # type: ignore
+
+
+_BULK_PERIOD: int = _CONFIG['fetcher']['bulk_period'] if 'fetcher' in _CONFIG else 8 # type: ignore
+
+
+# Issues `.lq.Lobby.fetchGameRecord` through the lobby connection the logged-in
+# page already has. The response is captured by the sniffer just as when the
+# paipu page is loaded.
+_FETCH_GAME_RECORD_SCRIPT = '''
+app.NetAgent.sendReq2Lobby(
+    'Lobby', 'fetchGameRecord',
+    {game_uuid: arguments[0], client_version_string: GameMgr.Inst.getClientVersion()},
+    function (error, response) {});
+'''
+
+
 def _click_canvas_within(
         driver: WebDriver, canvas: WebElement,
         left: int, top: int, width: int, height: int) -> None:
@@ -76,92 +123,347 @@ def _get_screenshot(process_rank: int, driver: WebDriver, name: str) -> None:
     driver.get_screenshot_as_file(str(screenshot_path)) # type: ignore
 
 
+# The resource timing buffer holds only 250 entries by default, which the game
+# exceeds while loading. Enlarge it before any script of the page runs so that
+# the number of entries keeps growing while resources are loaded.
+_ENLARGE_RESOURCE_TIMING_BUFFER_SCRIPT = 'performance.setResourceTimingBufferSize(1000000);'
+
+
+def _prepare_driver(driver: WebDriver) -> None:
+    driver.execute_cdp_cmd( # type: ignore
+        'Page.addScriptToEvaluateOnNewDocument',
+        {'source': _ENLARGE_RESOURCE_TIMING_BUFFER_SCRIPT})
+
+
+def _count_loaded_resources(driver: WebDriver) -> int:
+    count = driver.execute_script( # type: ignore
+        "return performance.getEntriesByType('resource').length;")
+    return int(count) # type: ignore
+
+
+# Waits until no resource has finished loading for `quiet_period` seconds. If
+# `baseline` is given, the network is not regarded as idle until more resources
+# than `baseline` have been loaded, that is, loading has started.
+def _wait_for_network_idle(
+        driver: WebDriver, timeout: float, quiet_period: float,
+        baseline: Optional[int]=None) -> None:
+    deadline = time.monotonic() + timeout
+    count = _count_loaded_resources(driver)
+    last_change = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            logging.warning('Timed out waiting for the network to be idle.')
+            return
+        new_count = _count_loaded_resources(driver)
+        if new_count != count:
+            count = new_count
+            last_change = now
+        elif (baseline is None or count > baseline) and now - last_change >= quiet_period:
+            return
+        time.sleep(0.2)
+
+
+# Takes a grayscale screenshot of the canvas, downscaled so that comparing
+# screenshots is cheap.
+def _get_canvas_image(canvas: WebElement) -> Image.Image:
+    png: bytes = canvas.screenshot_as_png # type: ignore
+    return Image.open(io.BytesIO(png)).convert('L').reduce(4)
+
+
+def _is_canvas_changed(before: Image.Image, after: Image.Image) -> bool:
+    if before.size != after.size:
+        return True
+    histogram = ImageChops.difference(before, after).histogram()
+    num_changed_pixels = sum(histogram[_CANVAS_PIXEL_THRESHOLD:])
+    return num_changed_pixels > _CANVAS_CHANGE_RATIO * before.width * before.height
+
+
+# Waits until the canvas reacts to an operation, that is, it changes from
+# `before` and then stays unchanged between two successive checks, where small
+# changes such as those by animations are ignored.
+def _wait_for_canvas_to_settle(
+        canvas: WebElement, before: Image.Image, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    previous = before
+    changed = False
+    while time.monotonic() < deadline:
+        time.sleep(0.1)
+        current = _get_canvas_image(canvas)
+        if _is_canvas_changed(previous, current):
+            changed = True
+        elif changed:
+            return
+        previous = current
+    logging.warning('Timed out waiting for the canvas to settle.')
+
+
+def _click_and_wait(
+        driver: WebDriver, canvas: WebElement,
+        left: int, top: int, width: int, height: int) -> None:
+    before = _get_canvas_image(canvas)
+    _click_canvas_within(driver, canvas, left, top, width, height)
+    _wait_for_canvas_to_settle(canvas, before, _UI_TIMEOUT)
+
+
+def _send_keys_and_wait(driver: WebDriver, canvas: WebElement, keys: str) -> None:
+    before = _get_canvas_image(canvas)
+    ActionChains(driver).send_keys(keys).perform() # type: ignore
+    _wait_for_canvas_to_settle(canvas, before, _UI_TIMEOUT)
+
+
 def _wait_for_page_to_present(driver: WebDriver) -> WebElement:
     canvas: WebElement = WebDriverWait(driver, 60).until( # type: ignore
         ec.visibility_of_element_located((By.ID, 'layaCanvas'))) # type: ignore
-    time.sleep(15)
+    # The title screen is ready once the resources for it have been loaded.
+    _wait_for_network_idle(driver, 60, 2.0)
     return canvas
 
 
-def _fetch(process_rank: int, email_address: str, driver: WebDriver) -> None:
+def _open_login_form(process_rank: int, email_address: str, driver: WebDriver) -> WebElement:
     driver.get('https://game.mahjongsoul.com/')
     canvas = _wait_for_page_to_present(driver)
     _get_screenshot(process_rank, driver, '00-load-page.png')
 
-    s3_bucket_name = _CONFIG['s3']['bucket_name']
-    assert isinstance(s3_bucket_name, str)
-    s3_key_prefix = _CONFIG['s3']['authentication_email_key_prefix']
-    assert isinstance(s3_key_prefix, str)
-    yostar_login = YostarLogin(email_address, s3_bucket_name, s3_key_prefix)
-
     # Click the "login" button.
-    _click_canvas_within(driver, canvas, 540, 177, 167, 38)
-    time.sleep(1)
+    _click_and_wait(driver, canvas, 540, 177, 167, 38)
     _get_screenshot(process_rank, driver, '01-click-login-button.png')
 
     # Click the "mail address" form to focus it.
-    _click_canvas_within(driver, canvas, 145, 154, 291, 30)
-    time.sleep(1)
-
-    email_address = yostar_login.get_email_address()
+    _click_and_wait(driver, canvas, 145, 154, 291, 30)
 
     # Input the email address to the "mail address" form.
-    ActionChains(driver).send_keys(email_address).perform() # type: ignore
-    time.sleep(1)
+    _send_keys_and_wait(driver, canvas, email_address)
     _get_screenshot(process_rank, driver, '02-input-email-address.png')
 
-    # Click the "get auth code" button.
+    return canvas
+
+
+def _log_in(process_rank: int, email_address: str, driver: WebDriver, canvas: WebElement) -> None:
+    s3_bucket_name = _CONFIG['s3']['bucket_name']
+    assert isinstance(s3_bucket_name, str)
+    s3_key_prefix = _CONFIG['s3']['authentication_email_key_prefix']
+    assert isinstance(s3_key_prefix, str)
+    yostar_login = YostarLogin(email_address, s3_bucket_name, s3_key_prefix)
+
+    # Click the "get auth code" button. The "confirm" dialog shows up once the
+    # request to send the auth code has completed.
     start_time = datetime.datetime.now(tz=datetime.timezone.utc)
-    _click_canvas_within(driver, canvas, 351, 206, 86, 36)
-    time.sleep(1)
+    num_resources = _count_loaded_resources(driver)
+    _click_and_wait(driver, canvas, 351, 206, 86, 36)
+    _wait_for_network_idle(driver, _UI_TIMEOUT, 0.5, num_resources)
     _get_screenshot(process_rank, driver, '03-click-get-code-button.png')
 
     # Click the "confirm" button.
-    _click_canvas_within(driver, canvas, 378, 273, 60, 23)
-    time.sleep(1)
+    _click_and_wait(driver, canvas, 378, 273, 60, 23)
     _get_screenshot(process_rank, driver, '04-click-confirm-button.png')
 
     # Click the "auth code" form to focus it.
-    _click_canvas_within(driver, canvas, 144, 211, 196, 30)
-    time.sleep(1)
+    _click_and_wait(driver, canvas, 144, 211, 196, 30)
 
     auth_code = yostar_login.get_auth_code(start_time, datetime.timedelta(minutes=1))
+    if auth_code is None:
+        raise RuntimeError('Failed to get the auth code.')
 
     # Input the auth code to the "auth code" form.
-    ActionChains(driver).send_keys(auth_code).perform() # type: ignore
-    time.sleep(1)
+    _send_keys_and_wait(driver, canvas, auth_code)
     _get_screenshot(process_rank, driver, '05-input-auth-code.png')
 
-    # Click the "login" button.
+    # Click the "login" button. The lobby is ready once the resources for it
+    # have been loaded.
+    num_resources = _count_loaded_resources(driver)
     _click_canvas_within(driver, canvas, 209, 293, 163, 37)
-
-    time.sleep(120)
+    _wait_for_network_idle(driver, 120, 3.0, num_resources)
 
     _get_screenshot(process_rank, driver, '06-lobby.png')
 
     logging.info('Ready.')
 
+
+# Returns a slot for each fetch that can be in flight at a time, each of which
+# is the tab to fetch with.
+def _get_fetch_slots(driver: WebDriver) -> List[str]:
+    if _FETCH_METHOD == 'lobby':
+        # All the requests share the lobby connection of the logged-in tab.
+        return [driver.current_window_handle] * _MAX_IN_FLIGHT
+
+    # Each paipu page loads the game and logs the account in again, which
+    # kicks out the sessions of the other tabs. Therefore, paipu pages are
+    # navigated to one at a time.
+    if _MAX_IN_FLIGHT > 1:
+        logging.warning(
+            '`max_in_flight` is ignored because the `navigate` method fetches game records'
+            ' one by one.')
+    return [driver.current_window_handle]
+
+
+_FETCHED_KEY_PREFIX = 'game-record-fetched.'
+
+
+# Requests from users are queued in the interactive lane, and those for
+# backfills and re-reviews in the bulk lane, which gets a share of the fetches
+# only as `_BULK_PERIOD` dictates while interactive requests are waiting.
+_INTERACTIVE_REQUEST_KEY = 'game-record-requests'
+_BULK_REQUEST_KEY = 'game-record-requests.bulk'
+
+
+# A fetch for a bulk request is marked while in flight, so that the sniffer
+# queues the game record to the bulk lane of the analyzer.
+_BULK_FETCH_KEY_PREFIX = 'game-record-fetches.bulk.'
+
+
+def _accept_request(encoded_uuid: bytes, bulk: bool) -> Optional[str]:
+    uuid = encoded_uuid.decode('UTF-8')
+    logging.info('%s: A request arrived.', uuid)
+
+    if bulk:
+        # A bulk request is made for a game record that has already been
+        # reviewed, so as to review it again.
+        return uuid
+
+    if _REDIS.hget('reviews', uuid) is not None:
+        logging.info('%s: Analysis cached.', uuid)
+        return None
+
+    if _REDIS.hget('game-record-fetched', uuid) is not None:
+        logging.info('%s: Analysis in progress.', uuid)
+        return None
+
+    return uuid
+
+
+def _start_fetch(driver: WebDriver, handle: str, uuid: str) -> None:
+    driver.switch_to.window(handle)
+    if _FETCH_METHOD == 'lobby':
+        driver.execute_script(_FETCH_GAME_RECORD_SCRIPT, uuid) # type: ignore
+        return
+
+    # Navigate without waiting for the page to load so that the completions
+    # and timeouts of the other fetches can be handled in the meantime.
+    driver.execute_script( # type: ignore
+        'window.location.href = arguments[0];',
+        f'https://game.mahjongsoul.com/?paipu={uuid}')
+
+
+# Keeps a fetch in flight in every slot of the logged-in session, so that up to
+# `_MAX_IN_FLIGHT` game records are fetched concurrently. Only the `lobby`
+# method has more than one slot, all of which share the lobby connection.
+def _dispatch(driver: WebDriver) -> None:
+    free_slots = _get_fetch_slots(driver)
+    # The tab and the deadline of each fetch in flight.
+    in_flight: Dict[str, Tuple[str, float]] = {}
+    lanes = PriorityLanes(_INTERACTIVE_REQUEST_KEY, _BULK_REQUEST_KEY, _BULK_PERIOD)
+
     while True:
-        encoded_uuid = _REDIS.blpop('game-record-requests')
-        assert isinstance(encoded_uuid, bytes)
-        uuid = encoded_uuid.decode('UTF-8')
-        logging.info('%s: A request arrived.', uuid)
+        now = time.monotonic()
+        for uuid, (handle, deadline) in list(in_flight.items()):
+            if now >= deadline:
+                logging.warning('%s: Timed out fetching the game record.', uuid)
+                # Let the next request for the game record start over.
+                pipeline = _REDIS.pipeline(transaction=False)
+                pipeline.delete(get_in_flight_key(uuid))
+                pipeline.hdel('game-record-fetched', uuid)
+                pipeline.execute()
+                del in_flight[uuid]
+                free_slots.append(handle)
+
+        # Wait for either the completion of a fetch in flight, which the
+        # sniffer pushes, or a new request if a slot is free.
+        keys = [f'{_FETCHED_KEY_PREFIX}{uuid}' for uuid in in_flight]
+        if len(free_slots) > 0:
+            # `BLPOP` pops from the first non-empty list in the order of keys.
+            keys.extend(lanes.get_keys())
+        timeout = 0
+        if len(in_flight) > 0:
+            next_deadline = min(deadline for _, deadline in in_flight.values())
+            timeout = max(math.ceil(next_deadline - now), 1)
+        result = _REDIS.blpop_any(keys, timeout)
+        if result is None:
+            continue
+        key, value = result
 
-        if _REDIS.hget('reviews', uuid) is not None:
-            logging.info('%s: Analysis cached.', uuid)
+        if key.startswith(_FETCHED_KEY_PREFIX):
+            uuid = key[len(_FETCHED_KEY_PREFIX):]
+            logging.info('%s: Fetched the game record.', uuid)
+            handle, _ = in_flight.pop(uuid)
+            free_slots.append(handle)
             continue
 
-        if _REDIS.hget('game-record-fetched', uuid) is not None:
-            logging.info('%s: Analysis in progress.', uuid)
+        lanes.on_pop(key)
+        uuid = _accept_request(value, key == _BULK_REQUEST_KEY)
+        if uuid is None or uuid in in_flight:
             continue
 
-        driver.get(f'https://game.mahjongsoul.com/?paipu={uuid}')
+        pipeline = _REDIS.pipeline()
+        # Drop the notification left by an earlier fetch that timed out, if any,
+        # so that it is not taken for the completion of this fetch.
+        pipeline.delete(f'{_FETCHED_KEY_PREFIX}{uuid}')
+        if key == _BULK_REQUEST_KEY:
+            pipeline.set(f'{_BULK_FETCH_KEY_PREFIX}{uuid}', '', ex=_FETCH_TIMEOUT)
+        pipeline.execute()
+        handle = free_slots.pop()
+        _start_fetch(driver, handle, uuid)
+        in_flight[uuid] = (handle, time.monotonic() + _FETCH_TIMEOUT)
+
+
+# Keeps standby browsers, each of which has the game loaded and the login form
+# filled in, so that a new session can take over the moment the active one
+# dies. A standby is not logged in yet, because logging in would kick out the
+# active session of the same account. Its replacement is warmed in the
+# background.
+class _SessionPool(object):
+    def __init__(
+            self, process_rank: int, email_address: str, options: Options,
+            capabilities: Dict[str, object]) -> None:
+        self.__process_rank = process_rank
+        self.__email_address = email_address
+        self.__options = options
+        self.__capabilities = capabilities
+        self.__standby: queue.Queue[Tuple[WebDriver, WebElement]] = queue.Queue()
+        self.__vacancies = threading.Semaphore(_NUM_STANDBY_SESSIONS)
+        if _NUM_STANDBY_SESSIONS > 0:
+            threading.Thread(target=self.__warm, daemon=True).start()
+
+    def __launch(self) -> Tuple[WebDriver, WebElement]:
+        driver = Chrome(options=self.__options, desired_capabilities=self.__capabilities)
+        try:
+            _prepare_driver(driver)
+            canvas = _open_login_form(self.__process_rank, self.__email_address, driver)
+        except:
+            driver.quit()
+            raise
+        return (driver, canvas)
+
+    def __warm(self) -> None:
+        while True:
+            self.__vacancies.acquire()
+            while True:
+                try:
+                    session = self.__launch()
+                    break
+                except Exception: # pylint: disable=broad-except
+                    logging.exception(
+                        'Failed to warm a standby session. So, retrying after %s-seconds'
+                        ' sleep...', _BROWSER_RESTART_INTERVAL)
+                    time.sleep(_BROWSER_RESTART_INTERVAL)
+            self.__standby.put(session)
+            logging.info('A standby session is ready.')
+
+    def acquire(self) -> Tuple[WebDriver, WebElement]:
+        if _NUM_STANDBY_SESSIONS == 0:
+            return self.__launch()
+        session = self.__standby.get()
+        self.__vacancies.release()
+        return session
+
 
-        for _ in range(60):
-            if _REDIS.hget('game-record-fetched', uuid) is not None:
-                logging.info('%s: Fetched the game record.', uuid)
-                break
-            time.sleep(1)
+def _wait_for_restart() -> None:
+    if _NUM_STANDBY_SESSIONS > 0:
+        logging.warning('Promoting a standby session...')
+        return
+    logging.warning(
+        'Restarting the browser after %s-seconds sleep...', _BROWSER_RESTART_INTERVAL)
+    time.sleep(_BROWSER_RESTART_INTERVAL)
 
 
 def _main() -> None:
@@ -199,34 +501,37 @@ def _main() -> None:
         user_agent = user_agent.replace('HeadlessChrome', 'Chrome')
     options.add_argument(f'--user-agent={user_agent}') # type: ignore
 
+    pool = _SessionPool(process_rank, email_address, options, capabilities)
+
     while True:
-        with Chrome(options=options, desired_capabilities=capabilities) as driver:
-            try:
-                _fetch(process_rank, email_address, driver)
-                sys.exit()
-            except UnexpectedAlertPresentException as exception:
-                if exception.alert_text == 'Laya3D init error,must support webGL!':
-                    logging.warning(
-                        '`Laya3D init error` occurred. So, restarting the browser after'
-                        ' %s-seconds sleep...', _BROWSER_RESTART_INTERVAL)
-                    time.sleep(_BROWSER_RESTART_INTERVAL)
-                    continue
-                if exception.alert_text == 'open failed':
-                    logging.warning(
-                        '`open failed` occurred. So, restarting the browser after %s-seconds'
-                        ' sleep...', _BROWSER_RESTART_INTERVAL)
-                    time.sleep(_BROWSER_RESTART_INTERVAL)
-                    continue
+        driver: Optional[WebDriver] = None
+        try:
+            driver, canvas = pool.acquire()
+            _log_in(process_rank, email_address, driver, canvas)
+            _dispatch(driver)
+            sys.exit()
+        except UnexpectedAlertPresentException as exception:
+            if exception.alert_text == 'Laya3D init error,must support webGL!':
+                logging.warning('`Laya3D init error` occurred.')
+                _wait_for_restart()
+                continue
+            if exception.alert_text == 'open failed':
+                logging.warning('`open failed` occurred.')
+                _wait_for_restart()
+                continue
+            if driver is not None:
                 _get_screenshot(process_rank, driver, '99-エラー.png')
-                logging.exception('Abort with an unhandled exception.')
-                raise
-            except Exception: # pylint: disable=broad-except
+            logging.exception('Abort with an unhandled exception.')
+            raise
+        except Exception: # pylint: disable=broad-except
+            if driver is not None:
                 _get_screenshot(process_rank, driver, '99-エラー.png')
-                logging.exception('Abort with an unhandled exception.')
-                logging.warning(
-                    'Restarting the browser after %s-seconds sleep...', _BROWSER_RESTART_INTERVAL)
-                time.sleep(_BROWSER_RESTART_INTERVAL)
-                continue
+            logging.exception('Abort with an unhandled exception.')
+            _wait_for_restart()
+            continue
+        finally:
+            if driver is not None:
+                driver.quit()
 
 
 if __name__ == '__main__':
@@ -1,20 +1,21 @@
-import re
+import threading
 import time
 import logging
-import json
 from http import HTTPStatus
-from typing import List, Dict
-from flask import (Flask, Response,)
+from flask import (Flask, Response, request,)
 from kanachan_reviewer.config import get_config
 from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.reviews import (
+    NOTIFICATION_CHANNEL_PATTERN, get_notification_channel, get_uuid_from_notification_channel,
+    get_review,)
+from kanachan_reviewer.frontend import (
+    TIMEOUT, is_valid_uuid, create_response_cache, initialize_fetchers, request_review,
+    decode_and_cache_review, make_response,)
 
 
 app = Flask(__name__)
 
 
-_TIMEOUT = 60
-
-
 _CONFIG = get_config()
 
 
@@ -25,15 +26,27 @@ assert isinstance(_REDIS_PORT, int)
 _REDIS = Redis(_REDIS_HOST, _REDIS_PORT)
 
 
-# Initialize fetchers.
-_EMAIL_ADDRESSES: List[str] = _CONFIG['yostar_login']['email_addresses'] # type: ignore
-for i, email_address in enumerate(_EMAIL_ADDRESSES):
-    process_info = {
-        'process_rank': i,
-        'email_address': email_address
-    }
-    process_info_json = json.dumps(process_info, separators=(',', ':'))
-    _REDIS.rpush('fetcher-initializers', process_info_json)
+_CACHE = create_response_cache(_CONFIG)
+
+
+initialize_fetchers(_REDIS, _CONFIG)
+
+
+# Invalidates the cached response whenever a review is written.
+def _invalidate_cache() -> None:
+    while True:
+        try:
+            with _REDIS.psubscribe(NOTIFICATION_CHANNEL_PATTERN) as subscription:
+                # Notifications published while not subscribed have been lost.
+                _CACHE.clear()
+                for channel, _ in subscription.listen():
+                    _CACHE.invalidate(get_uuid_from_notification_channel(channel))
+        except Exception: # pylint: disable=broad-except
+            logging.exception('Lost the subscription to review notifications.')
+        time.sleep(1)
+
+
+threading.Thread(target=_invalidate_cache, daemon=True).start()
 
 
 @app.route('/')
@@ -43,36 +56,40 @@ def top_page():
 
 @app.route('/<uuid>')
 def analyze(uuid: str):
-    match = re.search('^\\d{6}-[0-9A-Fa-f]{8}(?:-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}$', uuid)
-    if match is None:
+    if not is_valid_uuid(uuid):
         return Response(status=HTTPStatus.NOT_FOUND)
 
-    _REDIS.rpush('game-record-requests', uuid)
-    logging.info('%s: Requested a review.', uuid)
-
-    review_encoded = None
-    for _ in range(_TIMEOUT):
-        review_encoded = _REDIS.hget('reviews', uuid)
-        if review_encoded is not None:
+    generation = _CACHE.get_generation()
+    cached_response = _CACHE.get(uuid)
+    if cached_response is not None:
+        return make_response(Response, request, cached_response)
+
+    # Serve a cached review without touching the request queue.
+    stored_review = get_review(_REDIS, uuid)
+    if stored_review is not None:
+        logging.info('%s: The review is cached.', uuid)
+        return make_response(
+            Response, request, decode_and_cache_review(_CACHE, uuid, stored_review, generation))
+
+    # Subscribe to the completion notification before requesting the review so
+    # that the notification cannot be missed.
+    with _REDIS.subscribe(get_notification_channel(uuid)) as subscription:
+        request_review(_REDIS, uuid)
+
+        # The review may have been cached before the subscription started. The
+        # generation is obtained again right before each lookup, since any
+        # review written while waiting invalidates the one obtained before.
+        generation = _CACHE.get_generation()
+        stored_review = get_review(_REDIS, uuid)
+        if stored_review is None and subscription.get_message(TIMEOUT) is not None:
+            generation = _CACHE.get_generation()
+            stored_review = get_review(_REDIS, uuid)
+        if stored_review is not None:
             logging.info('%s: The review arrived.', uuid)
-            break
-        time.sleep(1)
 
-    if review_encoded is None:
+    if stored_review is None:
         logging.info('%s: The review timed out.', uuid)
         return Response(status=HTTPStatus.REQUEST_TIMEOUT)
 
-    review_with_timestamp_json = review_encoded.decode('UTF-8')
-    review_with_timestamp: Dict[str, object] = json.loads(review_with_timestamp_json)
-    error_code = review_with_timestamp['error_code']
-    if error_code == 1203:
-        logging.info('%s: No game is found.', uuid)
-        return Response(status=HTTPStatus.NOT_FOUND)
-    if error_code != 0:
-        logging.info('%s: An unknown error code `%s`.', uuid, error_code)
-        return Response(status=HTTPStatus.BAD_REQUEST)
-
-    review = review_with_timestamp['review']
-    review_json = json.dumps(review)
-    response = Response(response=review_json, status=HTTPStatus.OK, mimetype='application/json')
-    return response
+    return make_response(
+        Response, request, decode_and_cache_review(_CACHE, uuid, stored_review, generation))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import fcntl
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import zlib
+from typing import (Optional, Tuple, Iterable, List, Dict,)
+
+
+# An append-only file of zlib-compressed `ResGameRecord` messages. Each entry
+# consists of a header, the uuid, and the compressed message:
+#
+#   magic (4 bytes) | uuid length (2 bytes) | compressed length (4 bytes)
+#   | CRC-32 of the compressed message (4 bytes) | uuid | compressed message
+#
+# The index from uuid to offset is not stored but built by walking the
+# headers, which only touches one page per entry of the memory-mapped file.
+# If a game record is archived more than once, the last entry wins.
+_MAGIC = b'KRGR'
+_HEADER = struct.Struct('<4sHII')
+
+
+class Archive(object):
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__mmap: Optional[mmap.mmap] = None
+        # The offset, the length, and the CRC-32 of the compressed message of
+        # each uuid.
+        self.__index: Dict[str, Tuple[int, int, int]] = {}
+        # The end of the last complete entry indexed so far.
+        self.__end = 0
+        self.__lock = threading.Lock()
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__mmap is not None:
+                self.__mmap.close()
+                self.__mmap = None
+            os.close(self.__fd)
+
+    def __remap(self, size: int) -> None:
+        if self.__mmap is not None and len(self.__mmap) >= size:
+            return
+        if self.__mmap is not None:
+            self.__mmap.close()
+        self.__mmap = mmap.mmap(self.__fd, size, access=mmap.ACCESS_READ)
+
+    # Indexes the entries appended since the last call, possibly by other
+    # processes. Must be called with the file locked.
+    def __refresh(self) -> int:
+        size = os.fstat(self.__fd).st_size
+        if size <= self.__end:
+            return size
+        self.__remap(size)
+        assert self.__mmap is not None
+
+        offset = self.__end
+        while offset + _HEADER.size <= size:
+            magic, uuid_length, length, crc = _HEADER.unpack_from(self.__mmap, offset)
+            if magic != _MAGIC:
+                raise RuntimeError(f'{offset}: A corrupted archive entry.')
+            data_offset = offset + _HEADER.size + uuid_length
+            if data_offset + length > size:
+                break
+            uuid = self.__mmap[offset + _HEADER.size:data_offset].decode('UTF-8')
+            self.__index[uuid] = (data_offset, length, crc)
+            offset = data_offset + length
+        self.__end = offset
+        return size
+
+    def __refresh_shared(self) -> None:
+        if os.fstat(self.__fd).st_size <= self.__end:
+            return
+        fcntl.flock(self.__fd, fcntl.LOCK_SH)
+        try:
+            self.__refresh()
+        finally:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+    def append(self, uuid: str, game_record: bytes | memoryview) -> None:
+        encoded_uuid = uuid.encode('UTF-8')
+        compressed = zlib.compress(game_record)
+        header = _HEADER.pack(_MAGIC, len(encoded_uuid), len(compressed), zlib.crc32(compressed))
+        entry = memoryview(header + encoded_uuid + compressed)
+
+        with self.__lock:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            try:
+                size = self.__refresh()
+                if size > self.__end:
+                    # Drop the torn entry left by a writer that crashed.
+                    os.ftruncate(self.__fd, self.__end)
+                os.lseek(self.__fd, self.__end, os.SEEK_SET)
+                written = 0
+                while written < len(entry):
+                    written += os.write(self.__fd, entry[written:])
+                self.__refresh()
+            finally:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+    def __get(self, uuid: str) -> Optional[bytes]:
+        entry = self.__index.get(uuid)
+        if entry is None:
+            return None
+        offset, length, crc = entry
+        assert self.__mmap is not None
+        # Decompress straight out of the mapped pages without copying them.
+        with memoryview(self.__mmap)[offset:offset + length] as compressed:
+            if zlib.crc32(compressed) != crc:
+                raise RuntimeError(f'{uuid}: A corrupted archive entry.')
+            return zlib.decompress(compressed)
+
+    # Returns the serialized `ResGameRecord` messages of the uuids, or `None`
+    # for those not archived.
+    def get_many(self, uuids: Iterable[str]) -> List[Optional[bytes]]:
+        uuids = list(uuids)
+        with self.__lock:
+            self.__refresh_shared()
+            return [self.__get(uuid) for uuid in uuids]
+
+    def get(self, uuid: str) -> Optional[bytes]:
+        return self.get_many((uuid,))[0]
+
+    # Returns the uuids of all the archived game records in the order they
+    # were first archived.
+    def get_uuids(self) -> List[str]:
+        with self.__lock:
+            self.__refresh_shared()
+            return list(self.__index)
+
+    def contains(self, uuid: str) -> bool:
+        with self.__lock:
+            self.__refresh_shared()
+            return uuid in self.__index
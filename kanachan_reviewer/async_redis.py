@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import time
+from types import NoneType
+from typing import (Union, Optional, Tuple, AsyncIterator, List, Dict,)
+import redis.asyncio
+from redis.asyncio.client import (PubSub, Pipeline as RedisPipeline,)
+
+
+class AsyncSubscription(object):
+    def __init__(self, pubsub: PubSub) -> None:
+        self.__pubsub = pubsub
+
+    async def listen(self) -> AsyncIterator[Tuple[str, bytes]]:
+        async for message in self.__pubsub.listen(): # type: ignore
+            message: Dict[str, object]
+            if message['type'] not in ('message', 'pmessage'):
+                continue
+            channel = message['channel']
+            assert isinstance(channel, bytes)
+            data = message['data']
+            assert isinstance(data, bytes)
+            yield (channel.decode('UTF-8'), data)
+
+    async def close(self) -> None:
+        await self.__pubsub.close() # type: ignore
+
+
+class AsyncPipeline(object):
+    def __init__(self, pipeline: RedisPipeline) -> None:
+        self.__pipeline = pipeline
+
+    def hget(self, name: str, key: str) -> None:
+        self.__pipeline.hget(name, key) # type: ignore
+
+    async def execute(self) -> List[object]:
+        results: List[object] = await self.__pipeline.execute() # type: ignore
+        return results
+
+
+class AsyncRedis(object):
+    def __init__(self, host: str, port: int) -> None:
+        self.__redis = redis.asyncio.StrictRedis(host=host, port=port)
+
+    async def close(self) -> None:
+        await self.__redis.close()
+
+    def pipeline(self, transaction: bool=True) -> AsyncPipeline:
+        return AsyncPipeline(self.__redis.pipeline(transaction=transaction))
+
+    async def set(
+            self, name: str, value: Union[str, bytes, memoryview], *, nx: bool=False,
+            ex: Optional[int]=None) -> bool:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        result = await self.__redis.set(name, value, nx=nx, ex=ex) # type: ignore
+        return result is not None and bool(result)
+
+    async def rpush(self, name: str, value: Union[str, bytes, memoryview]) -> int:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        result = await self.__redis.rpush(name, value) # type: ignore
+        assert isinstance(result, int)
+        return result
+
+    async def hget(self, name: str, key: str) -> Optional[bytes]:
+        result = await self.__redis.hget(name, key) # type: ignore
+        assert isinstance(result, (bytes, NoneType))
+        return result
+
+    async def psubscribe(self, pattern: str, timeout: float=10.0) -> AsyncSubscription:
+        pubsub = self.__redis.pubsub()
+        await pubsub.psubscribe(pattern) # type: ignore
+
+        # Wait for the confirmation so that any message published after this
+        # method returns is guaranteed to be delivered to the subscription.
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                await pubsub.close() # type: ignore
+                raise RuntimeError(f'{pattern}: Failed to subscribe.')
+            message: Optional[Dict[str, object]] = await pubsub.get_message(
+                timeout=remaining) # type: ignore
+            if message is not None and message['type'] == 'psubscribe':
+                break
+
+        return AsyncSubscription(pubsub)
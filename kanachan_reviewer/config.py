@@ -118,6 +118,76 @@ _LOGGING_CONFIG_SCHEMA = {
     'additionalProperties': False
 }
 
+_FRONTEND_CACHE_CONFIG_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'max_entries': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'max_bytes': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'ttl': {
+            'type': 'integer',
+            'minimum': 0
+        }
+    },
+    'additionalProperties': False
+}
+
+_ARCHIVE_CONFIG_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'path': {
+            'type': 'string'
+        }
+    },
+    'additionalProperties': False
+}
+
+# `path` is a TorchScript model that scores the discard candidates of decision
+# points encoded as in `kanachan_reviewer.decision_points`, i.e.,
+# `model(sparse, numeric, progression, candidates)` with int64 `[B, 27]`,
+# float32 `[B, 6]`, int64 `[B, 256]`, and int64 `[B, 14]` tensors returning
+# float `[B, 14]` scores, where `B` is at most `batch_size`.
+_ANALYZER_MODEL_CONFIG_SCHEMA = {
+    'type': 'object',
+    'required': [
+        'path'
+    ],
+    'properties': {
+        'path': {
+            'type': 'string'
+        },
+        'batch_size': {
+            'type': 'integer',
+            'minimum': 1
+        },
+        'threads': {
+            'type': 'integer',
+            'minimum': 1
+        }
+    },
+    'additionalProperties': False
+}
+
+_ANALYZER_RE_REVIEW_CONFIG_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'interval': {
+            'type': 'integer',
+            'minimum': 1
+        },
+        'max_requests': {
+            'type': 'integer',
+            'minimum': 0
+        }
+    },
+    'additionalProperties': False
+}
+
 _CONFIG_SCHEMA = {
     'type': 'object',
     'required': [
@@ -128,6 +198,14 @@ _CONFIG_SCHEMA = {
         'redis': _REDIS_CONFIG_SHCEMA,
         's3': _S3_CONFIG_SCHEMA,
         'yostar_login': _YOSTAR_LOGIN_CONFIG_SCHEMA,
+        'archive': _ARCHIVE_CONFIG_SCHEMA,
+        'frontend': {
+            'type': 'object',
+            'properties': {
+                'cache': _FRONTEND_CACHE_CONFIG_SCHEMA
+            },
+            'additionalProperties': False
+        },
         'sniffer': {
             'type': 'object',
             'required': [
@@ -144,7 +222,25 @@ _CONFIG_SCHEMA = {
                 'logging'
             ],
             'properties': {
-                'logging': _LOGGING_CONFIG_SCHEMA
+                'logging': _LOGGING_CONFIG_SCHEMA,
+                'max_in_flight': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                'method': {
+                    'enum': [
+                        'navigate',
+                        'lobby'
+                    ]
+                },
+                'standby_sessions': {
+                    'type': 'integer',
+                    'minimum': 0
+                },
+                'bulk_period': {
+                    'type': 'integer',
+                    'minimum': 1
+                }
             },
             'additionalProperties': False
         },
@@ -154,7 +250,21 @@ _CONFIG_SCHEMA = {
                 'logging'
             ],
             'properties': {
-                'logging': _LOGGING_CONFIG_SCHEMA
+                'logging': _LOGGING_CONFIG_SCHEMA,
+                'batch_size': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                'model': _ANALYZER_MODEL_CONFIG_SCHEMA,
+                'workers': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                're_review': _ANALYZER_RE_REVIEW_CONFIG_SCHEMA,
+                'bulk_period': {
+                    'type': 'integer',
+                    'minimum': 1
+                }
             },
             'additionalProperties': False
         }
@@ -192,6 +302,22 @@ def get_config() -> Config:
     if 'port' not in _CONFIG['redis']:
         _CONFIG['redis']['port'] = 6379
 
+    if 'archive' not in _CONFIG:
+        _CONFIG['archive'] = {}
+    if 'path' not in _CONFIG['archive']:
+        _CONFIG['archive']['path'] = '/var/lib/kanachan-reviewer/game-records.dat'
+
+    if 'frontend' not in _CONFIG:
+        _CONFIG['frontend'] = {}
+    if 'cache' not in _CONFIG['frontend']:
+        _CONFIG['frontend']['cache'] = {} # type: ignore
+    if 'max_entries' not in _CONFIG['frontend']['cache']: # type: ignore
+        _CONFIG['frontend']['cache']['max_entries'] = 1024 # type: ignore
+    if 'max_bytes' not in _CONFIG['frontend']['cache']: # type: ignore
+        _CONFIG['frontend']['cache']['max_bytes'] = 67108864 # type: ignore
+    if 'ttl' not in _CONFIG['frontend']['cache']: # type: ignore
+        _CONFIG['frontend']['cache']['ttl'] = 3600 # type: ignore
+
     if 'sniffer' in _CONFIG:
         if 'level' not in _CONFIG['sniffer']['logging']: # type: ignore
             _CONFIG['sniffer']['logging']['level'] = 'INFO' # type: ignore
@@ -205,6 +331,14 @@ def get_config() -> Config:
                 _CONFIG['sniffer']['logging']['redis']['max_entries'] = 1024 # type: ignore
 
     if 'fetcher' in _CONFIG:
+        if 'max_in_flight' not in _CONFIG['fetcher']:
+            _CONFIG['fetcher']['max_in_flight'] = 1
+        if 'method' not in _CONFIG['fetcher']:
+            _CONFIG['fetcher']['method'] = 'navigate'
+        if 'standby_sessions' not in _CONFIG['fetcher']:
+            _CONFIG['fetcher']['standby_sessions'] = 0
+        if 'bulk_period' not in _CONFIG['fetcher']:
+            _CONFIG['fetcher']['bulk_period'] = 8
         if 'level' not in _CONFIG['fetcher']['logging']: # type: ignore
             _CONFIG['fetcher']['logging']['level'] = 'INFO' # type: ignore
         if 'file' in _CONFIG['fetcher']['logging']: # type: ignore
@@ -217,6 +351,23 @@ def get_config() -> Config:
                 _CONFIG['fetcher']['logging']['redis']['max_entries'] = 1024 # type: ignore
 
     if 'analyzer' in _CONFIG:
+        if 'batch_size' not in _CONFIG['analyzer']:
+            _CONFIG['analyzer']['batch_size'] = 16
+        if 'workers' not in _CONFIG['analyzer']:
+            _CONFIG['analyzer']['workers'] = 1
+        if 'bulk_period' not in _CONFIG['analyzer']:
+            _CONFIG['analyzer']['bulk_period'] = 8
+        if 're_review' not in _CONFIG['analyzer']:
+            _CONFIG['analyzer']['re_review'] = {} # type: ignore
+        if 'interval' not in _CONFIG['analyzer']['re_review']: # type: ignore
+            _CONFIG['analyzer']['re_review']['interval'] = 60 # type: ignore
+        if 'max_requests' not in _CONFIG['analyzer']['re_review']: # type: ignore
+            _CONFIG['analyzer']['re_review']['max_requests'] = 64 # type: ignore
+        if 'model' in _CONFIG['analyzer']:
+            if 'batch_size' not in _CONFIG['analyzer']['model']: # type: ignore
+                _CONFIG['analyzer']['model']['batch_size'] = 1024 # type: ignore
+            if 'threads' not in _CONFIG['analyzer']['model']: # type: ignore
+                _CONFIG['analyzer']['model']['threads'] = 1 # type: ignore
         if 'level' not in _CONFIG['analyzer']['logging']: # type: ignore
             _CONFIG['analyzer']['logging']['level'] = 'INFO' # type: ignore
         if 'file' in _CONFIG['analyzer']['logging']: # type: ignore
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+from typing import (Optional, Tuple, Iterator, NamedTuple, List,)
+from kanachan_reviewer.mahjongsoul_pb2 import (
+    Wrapper, ResGameRecord, GameDetailRecords, RecordNewRound, RecordDealTile,
+    RecordDiscardTile, RecordChiPengGang, RecordAnGangAddGang, RecordBaBei, LiQiSuccess,)
+
+
+# Tiles are indexed as follows: 0m (red 5m) = 0, 1m-9m = 1-9, 0p = 10,
+# 1p-9p = 11-19, 0s = 20, 1s-9s = 21-29, and 1z-7z = 30-36.
+NUM_TILES = 37
+
+
+TILE_NAMES = (
+    [f'{i}m' for i in range(10)] + [f'{i}p' for i in range(10)] + [f'{i}s' for i in range(10)]
+    + [f'{i}z' for i in range(1, 8)])
+
+
+def get_tile_index(tile: str) -> int:
+    if len(tile) != 2 or not tile[0].isdigit():
+        raise ValueError(f'{tile}: An invalid tile.')
+    number = int(tile[0])
+    suit = tile[1]
+    if suit == 'm':
+        return number
+    if suit == 'p':
+        return 10 + number
+    if suit == 's':
+        return 20 + number
+    if suit == 'z' and 1 <= number <= 7:
+        return 29 + number
+    raise ValueError(f'{tile}: An invalid tile.')
+
+
+def _get_tile_kind(tile: str) -> str:
+    # Red fives are of the same kind as the other fives.
+    return f'5{tile[1]}' if tile[0] == '0' else tile
+
+
+# A decision point is encoded into the following fixed-width features so that
+# decision points can be stacked into a batch as they are. Only discards are
+# encoded as decision points, and the encoding is this project's own rather
+# than that of kanachan's training data, so a model must be trained on exactly
+# these features. With a batch of `B` decision points, the model is given
+#
+#   `sparse`: int64 `[B, MAX_NUM_SPARSE_FEATURES]` (`[B, 27]`) in
+#     `[0, NUM_SPARSE_VALUES)` (`[0, 197)`),
+#   `numeric`: float32 `[B, NUM_NUMERIC_FEATURES]` (`[B, 6]`),
+#   `progression`: int64 `[B, MAX_PROGRESSION_LENGTH]` (`[B, 256]`) in
+#     `[0, NUM_PROGRESSION_VALUES)` (`[0, 314)`), and
+#   `candidates`: int64 `[B, MAX_NUM_CANDIDATES]` (`[B, 14]`) in
+#     `[0, NUM_TILES]` (`[0, 37]`),
+#
+# and must return float `[B, MAX_NUM_CANDIDATES]` scores, one for each entry
+# of `candidates`, where a higher score means a better discard. The scores of
+# padded candidates are ignored. Every index of the padding value is the last
+# one of its range.
+#
+# `sparse`: Indices into a single embedding table of `NUM_SPARSE_VALUES` rows,
+# padded with `SPARSE_PADDING`. The round wind (0-3), the dealer (0-3), the seat
+# relative to the dealer (0-3), the number of tiles left (0-69), the dora
+# indicators, the tiles in the hand, the tile just drawn, and the other players
+# in riichi relative to the deciding player (0-2) are offset as follows.
+_CHANG_OFFSET = 0
+_JU_OFFSET = _CHANG_OFFSET + 4
+_SEAT_OFFSET = _JU_OFFSET + 4
+_LEFT_TILE_COUNT_OFFSET = _SEAT_OFFSET + 4
+_DORA_OFFSET = _LEFT_TILE_COUNT_OFFSET + 70
+_HAND_OFFSET = _DORA_OFFSET + NUM_TILES
+_DRAWN_TILE_OFFSET = _HAND_OFFSET + NUM_TILES
+_RIICHI_OFFSET = _DRAWN_TILE_OFFSET + NUM_TILES
+SPARSE_PADDING = _RIICHI_OFFSET + 3
+NUM_SPARSE_VALUES = SPARSE_PADDING + 1
+MAX_NUM_SPARSE_FEATURES = 4 + 5 + 14 + 1 + 3
+#
+# `numeric`: The number of honba, the number of riichi sticks, and the scores
+# of the players in the order of seats starting from the deciding player.
+NUM_NUMERIC_FEATURES = 6
+#
+# `progression`: The beginning of the round followed by the discards and calls
+# so far, relative to the deciding player, and padded with
+# `PROGRESSION_PADDING`. Only the latest events are kept. A discard is
+# `_DISCARD_OFFSET + relative seat * 74 + tile * 2 + (1 if tsumogiri)`, and a
+# call is `_CALL_OFFSET + relative seat * 4 + type`, where the type is chi (0),
+# pon (1), daiminkan (2), or ankan or kakan (3).
+_BEGINNING_OF_ROUND = 0
+_DISCARD_OFFSET = _BEGINNING_OF_ROUND + 1
+_CALL_OFFSET = _DISCARD_OFFSET + 4 * NUM_TILES * 2
+PROGRESSION_PADDING = _CALL_OFFSET + 4 * 4
+NUM_PROGRESSION_VALUES = PROGRESSION_PADDING + 1
+MAX_PROGRESSION_LENGTH = 256
+#
+# `candidates`: The tiles that can be discarded in ascending order, padded
+# with `CANDIDATE_PADDING`.
+CANDIDATE_PADDING = NUM_TILES
+MAX_NUM_CANDIDATES = 14
+
+
+# The types of events in `progression`.
+_DISCARD = -1
+_CHI = 0
+_PENG = 1
+_MINGGANG = 2
+_ANGANG_OR_JIAGANG = 3
+
+
+class DecisionPoint(NamedTuple):
+    round_index: int
+    seat: int
+    sparse: List[int]
+    numeric: List[float]
+    progression: List[int]
+    candidates: List[int]
+    num_candidates: int
+    # The tile actually discarded.
+    actual: int
+
+
+# The round wind, the dealer, and the number of honba of a round.
+Round = Tuple[int, int, int]
+
+
+def _iterate_records(game_record: ResGameRecord) -> Iterator[Tuple[str, bytes]]:
+    if len(game_record.data) == 0: # pylint: disable=no-member
+        raise ValueError('The game record is not embedded in the response.')
+
+    wrapper = Wrapper()
+    wrapper.ParseFromString(game_record.data) # pylint: disable=no-member
+    if wrapper.name != '.lq.GameDetailRecords': # pylint: disable=no-member
+        raise ValueError(f'{wrapper.name}: An unexpected message.') # pylint: disable=no-member
+    details = GameDetailRecords()
+    details.ParseFromString(wrapper.data) # pylint: disable=no-member
+
+    if len(details.actions) > 0: # pylint: disable=no-member
+        # Newer game records hold the records as the results of actions.
+        records = [
+            action.result for action in details.actions # pylint: disable=no-member
+            if action.type == 1]
+    else:
+        records = list(details.records) # pylint: disable=no-member
+
+    for record in records:
+        wrapper.ParseFromString(record)
+        yield (wrapper.name, wrapper.data) # pylint: disable=no-member
+
+
+def _remove_tiles(hand: List[str], tile: str, count: int) -> None:
+    for _ in range(count):
+        if tile in hand:
+            hand.remove(tile)
+            continue
+        kind = _get_tile_kind(tile)
+        for i, t in enumerate(hand):
+            if _get_tile_kind(t) == kind:
+                del hand[i]
+                break
+        else:
+            raise ValueError(f'{tile}: Not in the hand.')
+
+
+class _RoundState(object):
+    def __init__(self, round_index: int, record: RecordNewRound) -> None:
+        self.round_index = round_index
+        self.chang: int = record.chang
+        self.ju: int = record.ju
+        self.ben: int = record.ben
+        self.liqibang: int = record.liqibang
+        self.scores: List[int] = list(record.scores)
+        self.doras: List[str] = list(record.doras) if len(record.doras) > 0 else [record.dora]
+        self.left_tile_count: int = record.left_tile_count
+        self.hands: List[List[str]] = [
+            list(record.tiles0), list(record.tiles1), list(record.tiles2), list(record.tiles3)]
+        self.drawn_tiles: List[Optional[str]] = [None] * 4
+        self.riichi = [False] * 4
+        # The actor, the type, and the value of each discard or call.
+        self.events: List[Tuple[int, int, int]] = []
+
+    def update_doras(self, doras: List[str]) -> None:
+        if len(doras) > 0:
+            self.doras = doras
+
+    def update_liqi(self, liqi: LiQiSuccess) -> None:
+        if liqi.failed:
+            return
+        self.scores[liqi.seat] = liqi.score
+        self.liqibang = liqi.liqibang
+
+    def encode(self, seat: int, actual: str) -> DecisionPoint:
+        num_players = len(self.scores)
+        hand = self.hands[seat]
+
+        sparse = [
+            _CHANG_OFFSET + self.chang,
+            _JU_OFFSET + self.ju,
+            _SEAT_OFFSET + (seat - self.ju) % 4,
+            _LEFT_TILE_COUNT_OFFSET + min(self.left_tile_count, 69)
+        ]
+        sparse.extend(_DORA_OFFSET + get_tile_index(dora) for dora in self.doras[:5])
+        sparse.extend(_HAND_OFFSET + get_tile_index(tile) for tile in hand[:14])
+        drawn_tile = self.drawn_tiles[seat]
+        if drawn_tile is not None:
+            sparse.append(_DRAWN_TILE_OFFSET + get_tile_index(drawn_tile))
+        for i in range(1, 4):
+            if self.riichi[(seat + i) % 4]:
+                sparse.append(_RIICHI_OFFSET + i - 1)
+        sparse.extend([SPARSE_PADDING] * (MAX_NUM_SPARSE_FEATURES - len(sparse)))
+
+        numeric = [float(self.ben), float(self.liqibang)]
+        for i in range(4):
+            if i < num_players:
+                numeric.append(self.scores[(seat + i) % num_players] / 10000.0)
+            else:
+                numeric.append(0.0)
+
+        progression = [_BEGINNING_OF_ROUND]
+        for actor, type_, value in self.events[-(MAX_PROGRESSION_LENGTH - 1):]:
+            relative_seat = (actor - seat) % 4
+            if type_ == _DISCARD:
+                progression.append(_DISCARD_OFFSET + relative_seat * NUM_TILES * 2 + value)
+            else:
+                progression.append(_CALL_OFFSET + relative_seat * 4 + type_)
+        progression.extend([PROGRESSION_PADDING] * (MAX_PROGRESSION_LENGTH - len(progression)))
+
+        candidates = sorted(set(get_tile_index(tile) for tile in hand))[:MAX_NUM_CANDIDATES]
+        num_candidates = len(candidates)
+        candidates.extend([CANDIDATE_PADDING] * (MAX_NUM_CANDIDATES - num_candidates))
+
+        return DecisionPoint(
+            self.round_index, seat, sparse, numeric, progression, candidates, num_candidates,
+            get_tile_index(actual))
+
+
+# Replays a game record and extracts the discard decisions made in it.
+def extract_decision_points(
+        game_record: ResGameRecord) -> Tuple[List[Round], List[DecisionPoint]]:
+    rounds: List[Round] = []
+    decision_points: List[DecisionPoint] = []
+    state: Optional[_RoundState] = None
+
+    for name, data in _iterate_records(game_record):
+        if name == '.lq.RecordNewRound':
+            new_round = RecordNewRound()
+            new_round.ParseFromString(data)
+            state = _RoundState(len(rounds), new_round)
+            rounds.append((state.chang, state.ju, state.ben))
+            continue
+        if state is None:
+            continue
+
+        if name == '.lq.RecordDealTile':
+            deal = RecordDealTile()
+            deal.ParseFromString(data)
+            state.hands[deal.seat].append(deal.tile)
+            state.drawn_tiles[deal.seat] = deal.tile
+            state.left_tile_count = deal.left_tile_count
+            state.update_doras(list(deal.doras))
+            if deal.HasField('liqi'):
+                state.update_liqi(deal.liqi)
+        elif name == '.lq.RecordDiscardTile':
+            discard = RecordDiscardTile()
+            discard.ParseFromString(data)
+            decision_points.append(state.encode(discard.seat, discard.tile))
+            _remove_tiles(state.hands[discard.seat], discard.tile, 1)
+            state.drawn_tiles[discard.seat] = None
+            if discard.is_liqi or discard.is_wliqi:
+                state.riichi[discard.seat] = True
+            value = get_tile_index(discard.tile) * 2 + (1 if discard.moqie else 0)
+            state.events.append((discard.seat, _DISCARD, value))
+            state.update_doras(list(discard.doras))
+        elif name == '.lq.RecordChiPengGang':
+            call = RecordChiPengGang()
+            call.ParseFromString(data)
+            for tile, from_ in zip(call.tiles, call.froms):
+                if from_ == call.seat:
+                    _remove_tiles(state.hands[call.seat], tile, 1)
+            state.drawn_tiles[call.seat] = None
+            state.events.append((call.seat, min(call.type, _MINGGANG), 0))
+            if call.HasField('liqi'):
+                state.update_liqi(call.liqi)
+        elif name == '.lq.RecordAnGangAddGang':
+            gang = RecordAnGangAddGang()
+            gang.ParseFromString(data)
+            _remove_tiles(state.hands[gang.seat], gang.tiles, 4 if gang.type == 3 else 1)
+            state.drawn_tiles[gang.seat] = None
+            state.events.append((gang.seat, _ANGANG_OR_JIAGANG, 0))
+            state.update_doras(list(gang.doras))
+        elif name == '.lq.RecordBaBei':
+            babei = RecordBaBei()
+            babei.ParseFromString(data)
+            _remove_tiles(state.hands[babei.seat], '4z', 1)
+            state.drawn_tiles[babei.seat] = None
+            state.update_doras(list(babei.doras))
+
+    return (rounds, decision_points)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import re
+import logging
+import json
+from http import HTTPStatus
+from typing import (Any, List, Dict,)
+from kanachan_reviewer.config import Config
+from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.async_redis import AsyncRedis
+from kanachan_reviewer.reviews import (UNSUPPORTED_ERROR_CODE, StoredReview, get_in_flight_key,)
+from kanachan_reviewer.response_cache import (CachedResponse, ResponseCache,)
+
+
+TIMEOUT = 60
+
+
+CACHE_CONTROL = 'public, max-age=3600'
+
+
+_UUID_PATTERN = re.compile('^\\d{6}-[0-9A-Fa-f]{8}(?:-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}$')
+
+
+def is_valid_uuid(uuid: str) -> bool:
+    return _UUID_PATTERN.search(uuid) is not None
+
+
+def create_response_cache(config: Config) -> ResponseCache:
+    cache_config: Dict[str, int] = config['frontend']['cache'] # type: ignore
+    return ResponseCache(cache_config['max_entries'], cache_config['max_bytes'], cache_config['ttl'])
+
+
+def initialize_fetchers(redis: Redis, config: Config) -> None:
+    email_addresses: List[str] = config['yostar_login']['email_addresses'] # type: ignore
+    for i, email_address in enumerate(email_addresses):
+        process_info = {
+            'process_rank': i,
+            'email_address': email_address
+        }
+        process_info_json = json.dumps(process_info, separators=(',', ':'))
+        redis.rpush('fetcher-initializers', process_info_json)
+
+
+# Only the first request for a uuid enqueues the work. The following requests
+# attach to the in-flight one by waiting for the same review notification. The
+# in-flight mark is removed when the work finishes, and otherwise expires with
+# the timeout so that a lost request is retried.
+def request_review(redis: Redis, uuid: str) -> bool:
+    if not redis.set(get_in_flight_key(uuid), '1', nx=True, ex=TIMEOUT):
+        logging.info('%s: Attached to the in-flight request.', uuid)
+        return False
+    redis.rpush('game-record-requests', uuid)
+    logging.info('%s: Requested a review.', uuid)
+    return True
+
+
+async def async_request_review(redis: AsyncRedis, uuid: str) -> bool:
+    if not await redis.set(get_in_flight_key(uuid), '1', nx=True, ex=TIMEOUT):
+        logging.info('%s: Attached to the in-flight request.', uuid)
+        return False
+    await redis.rpush('game-record-requests', uuid)
+    logging.info('%s: Requested a review.', uuid)
+    return True
+
+
+def decode_review(uuid: str, stored_review: StoredReview) -> CachedResponse:
+    metadata, body, gzip_body = stored_review
+    error_code = metadata['error_code']
+    if error_code == 1203:
+        logging.info('%s: No game is found.', uuid)
+        return (HTTPStatus.NOT_FOUND, None, None, None)
+    if error_code == UNSUPPORTED_ERROR_CODE:
+        logging.info('%s: The game record is not supported.', uuid)
+        return (HTTPStatus.UNPROCESSABLE_ENTITY, None, None, None)
+    if error_code != 0:
+        logging.info('%s: An unknown error code `%s`.', uuid, error_code)
+        return (HTTPStatus.BAD_REQUEST, None, None, None)
+    if body is None:
+        raise RuntimeError(f'{uuid}: The body of the review is missing.')
+
+    # The time when a review was stored identifies its content.
+    etag = str(metadata['timestamp'])
+    return (HTTPStatus.OK, etag, body, gzip_body)
+
+
+# `generation` must be obtained from `cache` before `stored_review` is looked
+# up.
+def decode_and_cache_review(
+        cache: ResponseCache, uuid: str, stored_review: StoredReview,
+        generation: int) -> CachedResponse:
+    response = decode_review(uuid, stored_review)
+    cache.put(uuid, response, generation)
+    return response
+
+
+# Builds the response to `request` from a cached response. `response_class` and
+# `request` are those of the web framework in use, either Flask or Quart, both
+# of which provide the interface used here.
+def make_response(response_class: Any, request: Any, cached_response: CachedResponse) -> Any:
+    status, etag, body, gzip_body = cached_response
+    if body is None:
+        return response_class(status=status)
+    assert etag is not None
+
+    if request.if_none_match.contains(etag):
+        response = response_class(status=HTTPStatus.NOT_MODIFIED)
+    elif gzip_body is not None and 'gzip' in request.accept_encodings:
+        response = response_class(response=gzip_body, status=status, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = response_class(response=body, status=status, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import logging
+from typing import (Iterable, List,)
+from google.protobuf.internal import api_implementation
+from kanachan_reviewer.mahjongsoul_pb2 import (Wrapper, ResGameRecord,)
+
+
+# Decodes a `.lq.Lobby.fetchGameRecord` response message captured by the
+# sniffer, which consists of a 3-byte header followed by a `Wrapper`.
+def decode_game_record(content: bytes) -> ResGameRecord:
+    return decode_game_records((content,))[0]
+
+
+# Decodes many response messages in one call. The wrapper is reused across
+# messages.
+def decode_game_records(contents: Iterable[bytes]) -> List[ResGameRecord]:
+    wrapper = Wrapper()
+    game_records: List[ResGameRecord] = []
+    for content in contents:
+        wrapper.ParseFromString(content[3:])
+        if wrapper.name != '': # pylint: disable=no-member
+            raise RuntimeError(f'{wrapper.name}: An invalid message.') # pylint: disable=no-member
+        game_record = ResGameRecord()
+        game_record.ParseFromString(wrapper.data) # pylint: disable=no-member
+        game_records.append(game_record)
+    return game_records
+
+
+# Makes sure that the generated `mahjongsoul_pb2` works with the protobuf
+# backend in use by round-tripping a message through it.
+def verify_protobuf_implementation() -> None:
+    implementation = api_implementation.Type()
+    if implementation == 'python':
+        logging.warning('The pure-Python protobuf backend is in use.')
+    else:
+        logging.info('The `%s` protobuf backend is in use.', implementation)
+
+    game_record = ResGameRecord()
+    game_record.head.uuid = '000000-00000000-0000-0000-0000-000000000000' # pylint: disable=no-member
+    game_record.data = b'\x00\x01\x02' # pylint: disable=no-member
+    wrapper = Wrapper()
+    wrapper.data = game_record.SerializeToString() # pylint: disable=no-member
+    content = b'\x03\x00\x00' + wrapper.SerializeToString()
+    if decode_game_record(content) != game_record:
+        raise RuntimeError(
+            f'The generated protobuf code does not work with the `{implementation}` backend.')
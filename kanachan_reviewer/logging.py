@@ -7,7 +7,7 @@ from typing import Optional, List, Dict
 import sys
 from kanachan_reviewer.config import Config
 from kanachan_reviewer.redis import Redis
-from kanachan_reviewer.redis_log_handler import RedisLogHandler
+from kanachan_reviewer.redis_log_handler import BufferedRedisLogHandler
 
 
 _INITIALIZED = False
@@ -59,7 +59,8 @@ def initialize(service_name: str, process_rank: Optional[int], redis: Redis, con
         assert isinstance(redis_logging_key, str)
         redis_logging_max_entries = redis_logging_config['max_entries']
         assert isinstance(redis_logging_max_entries, int)
-        redis_handler = RedisLogHandler(redis, redis_logging_key, redis_logging_max_entries)
+        redis_handler = BufferedRedisLogHandler(
+            redis, redis_logging_key, redis_logging_max_entries)
         handlers.append(redis_handler)
 
     log_format = '%(asctime)s:%(filename)s:%(funcName)s:%(lineno)d:%(levelname)s: %(message)s'
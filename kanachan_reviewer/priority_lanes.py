@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+from typing import List
+
+
+# Decides the order in which the interactive and bulk lanes of a queue are
+# served. The interactive lane is served first, except that every `period`-th
+# pop in a row from the interactive lane gives way to the bulk lane, so that
+# bulk work keeps making progress while interactive work saturates the queue.
+class PriorityLanes(object):
+    def __init__(self, interactive_key: str, bulk_key: str, period: int) -> None:
+        if period < 1:
+            raise ValueError(f'{period}: An invalid period.')
+        self.__interactive_key = interactive_key
+        self.__bulk_key = bulk_key
+        self.__period = period
+        self.__interactive_streak = 0
+
+    def get_interactive_key(self) -> str:
+        return self.__interactive_key
+
+    def get_bulk_key(self) -> str:
+        return self.__bulk_key
+
+    # Returns the keys of the lanes in the order they should be tried for the
+    # next pop.
+    def get_keys(self) -> List[str]:
+        if self.__interactive_streak + 1 >= self.__period:
+            return [self.__bulk_key, self.__interactive_key]
+        return [self.__interactive_key, self.__bulk_key]
+
+    # Records the lane of a pop.
+    def on_pop(self, key: str) -> None:
+        if key == self.__interactive_key:
+            self.__interactive_streak += 1
+        elif key == self.__bulk_key:
+            self.__interactive_streak = 0
+        else:
+            raise ValueError(f'{key}: An unknown lane.')
@@ -1,14 +1,178 @@
 #!/usr/bin/env python3
 
+import time
 from types import NoneType
-from typing import Union, Optional, List, Dict
+from typing import Union, Optional, Tuple, Iterator, Sequence, List, Dict, Set
 import redis
+from redis.client import (PubSub, Pipeline as RedisPipeline,)
+
+
+class Subscription(object):
+    def __init__(self, pubsub: PubSub) -> None:
+        self.__pubsub = pubsub
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, exc_type: object, exc_value: object, traceback: object) -> None:
+        self.close()
+
+    def get_message(self, timeout: float) -> Optional[bytes]:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                return None
+            message: Optional[Dict[str, object]] = self.__pubsub.get_message(
+                timeout=remaining) # type: ignore
+            if message is None:
+                continue
+            if message['type'] not in ('message', 'pmessage'):
+                continue
+            data = message['data']
+            assert isinstance(data, bytes)
+            return data
+
+    def listen(self) -> Iterator[Tuple[str, bytes]]:
+        for message in self.__pubsub.listen(): # type: ignore
+            message: Dict[str, object]
+            if message['type'] not in ('message', 'pmessage'):
+                continue
+            channel = message['channel']
+            assert isinstance(channel, bytes)
+            data = message['data']
+            assert isinstance(data, bytes)
+            yield (channel.decode('UTF-8'), data)
+
+    def close(self) -> None:
+        self.__pubsub.close() # type: ignore
+
+
+class Pipeline(object):
+    def __init__(self, pipeline: RedisPipeline) -> None:
+        self.__pipeline = pipeline
+
+    def hset(self, name: str, key: str, value: Union[str, bytes, memoryview]) -> None:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self.__pipeline.hset(name, key, value) # type: ignore
+
+    def hsetnx(self, name: str, key: str, value: Union[str, bytes, memoryview]) -> None:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self.__pipeline.hsetnx(name, key, value) # type: ignore
+
+    def set(
+            self, name: str, value: Union[str, bytes, memoryview], *,
+            ex: Optional[int]=None) -> None:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self.__pipeline.set(name, value, ex=ex) # type: ignore
+
+    def hget(self, name: str, key: Union[str, bytes]) -> None:
+        self.__pipeline.hget(name, key) # type: ignore
+
+    def hincrby(self, name: str, key: Union[str, bytes], amount: int=1) -> None:
+        self.__pipeline.hincrby(name, key, amount) # type: ignore
+
+    def hgetall(self, name: str) -> None:
+        self.__pipeline.hgetall(name) # type: ignore
+
+    def rpush(self, name: str, value: Union[str, bytes, memoryview]) -> None:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self.__pipeline.rpush(name, value) # type: ignore
+
+    def rpush_many(self, name: str, values: Sequence[Union[str, bytes, memoryview]]) -> None:
+        encoded_values = [v.encode('UTF-8') if isinstance(v, str) else v for v in values]
+        self.__pipeline.rpush(name, *encoded_values) # type: ignore
+
+    def ltrim(self, name: str, start: int, end: int) -> None:
+        self.__pipeline.ltrim(name, start, end) # type: ignore
+
+    def expire(self, name: str, seconds: int) -> None:
+        self.__pipeline.expire(name, seconds) # type: ignore
+
+    def delete(self, name: str) -> None:
+        self.__pipeline.delete(name) # type: ignore
+
+    def lmove(self, source: str, destination: str, src: str='LEFT', dest: str='RIGHT') -> None:
+        self.__pipeline.lmove(source, destination, src, dest) # type: ignore
+
+    def hdel(self, name: str, key: Union[str, bytes]) -> None:
+        self.__pipeline.hdel(name, key) # type: ignore
+
+    def lrem(self, name: str, count: int, value: Union[str, bytes, memoryview]) -> None:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        self.__pipeline.lrem(name, count, value) # type: ignore
+
+    def sadd(self, name: str, value: str) -> None:
+        self.__pipeline.sadd(name, value) # type: ignore
+
+    def publish(self, channel: str, message: Union[str, bytes, memoryview]) -> None:
+        if isinstance(message, str):
+            message = message.encode('UTF-8')
+        self.__pipeline.publish(channel, message) # type: ignore
+
+    def eval(
+            self, script: str, keys: Sequence[str],
+            args: Sequence[Union[str, bytes, memoryview]]) -> None:
+        encoded_args = [a.encode('UTF-8') if isinstance(a, str) else a for a in args]
+        self.__pipeline.eval(script, len(keys), *keys, *encoded_args) # type: ignore
+
+    def execute(self) -> List[object]:
+        results: List[object] = self.__pipeline.execute() # type: ignore
+        return results
 
 
 class Redis(object):
     def __init__(self, host: str, port: int) -> None:
         self.__redis = redis.StrictRedis(host, port)
 
+    def pipeline(self, transaction: bool=True) -> Pipeline:
+        return Pipeline(self.__redis.pipeline(transaction=transaction))
+
+    def set(
+            self, name: str, value: Union[str, bytes, memoryview], *, nx: bool=False,
+            ex: Optional[int]=None) -> bool:
+        if isinstance(value, str):
+            value = value.encode('UTF-8')
+        result = self.__redis.set(name, value, nx=nx, ex=ex)
+        return result is not None and bool(result)
+
+    def get(self, name: str) -> Optional[bytes]:
+        result = self.__redis.get(name)
+        assert isinstance(result, (bytes, NoneType))
+        return result
+
+    def getdel(self, name: str) -> Optional[bytes]:
+        result = self.__redis.getdel(name)
+        assert isinstance(result, (bytes, NoneType))
+        return result
+
+    def delete(self, name: str) -> int:
+        result = self.__redis.delete(name)
+        assert isinstance(result, int)
+        return result
+
+    def exists(self, name: str) -> bool:
+        result = self.__redis.exists(name)
+        assert isinstance(result, int)
+        return result == 1
+
+    def srem(self, name: str, value: str) -> bool:
+        result: int = self.__redis.srem(name, value) # type: ignore
+        return result == 1
+
+    def smembers(self, name: str) -> List[str]:
+        result: Set[bytes] = self.__redis.smembers(name) # type: ignore
+        members: List[str] = []
+        for member in result:
+            assert isinstance(member, bytes)
+            members.append(member.decode('UTF-8'))
+        return members
+
     def postincr(self, name: str) -> int:
         result = int(self.__redis.incr(name)) # type: ignore
         assert result >= 1
@@ -37,11 +201,45 @@ class Redis(object):
             raise RuntimeError(f'{result[0]} != {name.encode("UTF-8")}')
         return result[1]
 
+    # Pops from the first non-empty list of `names`, and returns its name
+    # together with the popped value.
+    def blpop_any(self, names: List[str], timeout: int=0) -> Optional[Tuple[str, bytes]]:
+        result: Optional[List[bytes]] = self.__redis.blpop(names, timeout) # type: ignore
+        if result is None:
+            return None
+        if len(result) != 2:
+            raise RuntimeError(f'{str(result)}: Failed to execute `blpop`.')
+        name = result[0].decode('UTF-8')
+        if name not in names:
+            raise RuntimeError(f'{name}: An unexpected key.')
+        return (name, result[1])
+
+    # Atomically pops a value from `source` and pushes it to `destination`.
+    def lmove(
+            self, source: str, destination: str, src: str='LEFT',
+            dest: str='RIGHT') -> Optional[bytes]:
+        result = self.__redis.lmove(source, destination, src, dest) # type: ignore
+        assert isinstance(result, (bytes, NoneType))
+        return result
+
+    def blmove(
+            self, source: str, destination: str, timeout: int=0, src: str='LEFT',
+            dest: str='RIGHT') -> Optional[bytes]:
+        result = self.__redis.blmove(source, destination, timeout, src, dest) # type: ignore
+        assert isinstance(result, (bytes, NoneType))
+        return result
+
     def llen(self, name: str) -> int:
         result = self.__redis.llen(name)
         assert isinstance(result, int)
         return result
 
+    def lrange(self, name: str, start: int, end: int) -> List[bytes]:
+        result: List[bytes] = self.__redis.lrange(name, start, end) # type: ignore
+        for value in result:
+            assert isinstance(value, bytes)
+        return result
+
     def hset(self, name: str, key: str, value: Union[str, bytes, memoryview]) -> None:
         if isinstance(value, str):
             value = value.encode('UTF-8')
@@ -55,11 +253,61 @@ class Redis(object):
         result: int = self.__redis.hsetnx(name, key, value) # type: ignore
         return result == 1
 
-    def hget(self, name: str, key: str) -> Optional[bytes]:
+    def hget(self, name: str, key: Union[str, bytes]) -> Optional[bytes]:
         result = self.__redis.hget(name, key)
         assert isinstance(result, (bytes, NoneType))
         return result
 
+    def hdel(self, name: str, key: Union[str, bytes]) -> bool:
+        result: int = self.__redis.hdel(name, key) # type: ignore
+        return result == 1
+
+    def publish(self, channel: str, message: Union[str, bytes, memoryview]) -> int:
+        if isinstance(message, str):
+            message = message.encode('UTF-8')
+        result = self.__redis.publish(channel, message)
+        assert isinstance(result, int)
+        return result
+
+    def __subscribe(self, pubsub: PubSub, confirmation: str, timeout: float) -> Subscription:
+        # Wait for the confirmation so that any message published after this
+        # method returns is guaranteed to be delivered to the subscription.
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                pubsub.close() # type: ignore
+                raise RuntimeError('Failed to subscribe.')
+            message: Optional[Dict[str, object]] = pubsub.get_message(
+                timeout=remaining) # type: ignore
+            if message is not None and message['type'] == confirmation:
+                break
+
+        return Subscription(pubsub)
+
+    def subscribe(self, channel: str, timeout: float=10.0) -> Subscription:
+        pubsub = self.__redis.pubsub()
+        pubsub.subscribe(channel) # type: ignore
+        return self.__subscribe(pubsub, 'subscribe', timeout)
+
+    def psubscribe(self, pattern: str, timeout: float=10.0) -> Subscription:
+        pubsub = self.__redis.pubsub()
+        pubsub.psubscribe(pattern) # type: ignore
+        return self.__subscribe(pubsub, 'psubscribe', timeout)
+
+    # Iterates over a hash a chunk at a time. Returns the cursor to pass to
+    # the next call, which is zero at the end, together with the chunk.
+    def hscan(self, name: str, cursor: int, count: int) -> Tuple[int, Dict[str, bytes]]:
+        result: Tuple[int, Dict[bytes, bytes]] = self.__redis.hscan( # type: ignore
+            name, cursor, count=count)
+        next_cursor, items = result
+        decoded_items: Dict[str, bytes] = {}
+        for key, value in items.items():
+            assert isinstance(key, bytes)
+            assert isinstance(value, bytes)
+            decoded_items[key.decode('UTF-8')] = value
+        return (int(next_cursor), decoded_items)
+
     def hgetall(self, name: str) -> Dict[str, bytes]:
         results: Dict[str, bytes] = self.__redis.hgetall(name) # type: ignore
         for key, value in results.items():
@@ -1,23 +1,106 @@
 #!/usr/bin/env python3
 
+from collections import deque
 import logging
+import threading
+from typing import (Deque, List,)
 from kanachan_reviewer.redis import Redis
 
 
-class RedisLogHandler(logging.Handler):
-    def __init__(self, redis: Redis, key: str, max_entries: int) -> None:
+# Buffers log records and writes them from a background thread, so that
+# logging never waits for Redis. Each flush issues one pipelined `RPUSH` of the
+# whole batch followed by `LTRIM`. A flush happens once `batch_size` records
+# are buffered or `flush_interval` seconds have passed. When `capacity`
+# records are already buffered, new records are dropped rather than blocking
+# the caller, and the number of dropped records is logged with the next flush.
+class BufferedRedisLogHandler(logging.Handler):
+    def __init__(
+            self, redis: Redis, key: str, max_entries: int, *, capacity: int=4096,
+            batch_size: int=256, flush_interval: float=1.0) -> None:
         super().__init__()
 
         self.__redis = redis
         self.__key = key
         self.__max_entries = max_entries
+        self.__capacity = capacity
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
 
-    def emit(self, record: logging.LogRecord) -> None:
-        message = super().format(record)
-        self.__redis.rpush(self.__key, message)
+        self.__buffer: Deque[str] = deque()
+        self.__num_dropped = 0
+        # Whether the records taken out of the buffer are being written.
+        self.__writing = False
+        self.__flush_requested = False
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
 
-        if self.__max_entries == 0:
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            message = self.format(record)
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
             return
 
-        while self.__redis.llen(self.__key) > self.__max_entries:
-            self.__redis.lpop(self.__key)
+        with self.__condition:
+            if len(self.__buffer) >= self.__capacity:
+                self.__num_dropped += 1
+                return
+            self.__buffer.append(message)
+            if len(self.__buffer) >= self.__batch_size:
+                self.__condition.notify()
+
+    def __write(self, messages: List[str]) -> None:
+        pipeline = self.__redis.pipeline(transaction=False)
+        pipeline.rpush_many(self.__key, messages)
+        if self.__max_entries > 0:
+            pipeline.ltrim(self.__key, -self.__max_entries, -1)
+        pipeline.execute()
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda: len(self.__buffer) >= self.__batch_size or self.__flush_requested
+                    or self.__closed, self.__flush_interval)
+                self.__flush_requested = False
+                messages = list(self.__buffer)
+                self.__buffer.clear()
+                num_dropped = self.__num_dropped
+                self.__num_dropped = 0
+                closed = self.__closed
+                self.__writing = True
+
+            if num_dropped > 0:
+                messages.append(f'{num_dropped} log record(s) dropped due to a full buffer.')
+            if len(messages) > 0:
+                try:
+                    self.__write(messages)
+                except Exception: # pylint: disable=broad-except
+                    # Logging the failure would only feed the buffer again.
+                    self.handleError(logging.makeLogRecord({
+                        'msg': f'Failed to write {len(messages)} log record(s) to Redis.'
+                    }))
+
+            with self.__condition:
+                self.__writing = False
+                self.__condition.notify_all()
+            if closed:
+                return
+
+    def flush(self) -> None:
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__flush_requested = True
+            self.__condition.notify_all()
+            self.__condition.wait_for(
+                lambda: len(self.__buffer) == 0 and not self.__writing, self.__flush_interval)
+
+    def close(self) -> None:
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join(self.__flush_interval)
+        super().close()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import time
+from typing import (Optional, Tuple,)
+
+
+# Tracks the requests of a WebSocket connection that are waiting for their
+# responses, keyed by the request number. Only the method name and the uuid of
+# each request are kept. The table holds at most `max_entries` entries, the
+# oldest being evicted first, and entries older than `ttl` seconds are expired,
+# so that requests whose responses never arrive do not pile up.
+class RequestTable(object):
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        if max_entries < 1:
+            raise ValueError(f'{max_entries}: An invalid number of entries.')
+        if ttl <= 0.0:
+            raise ValueError(f'{ttl}: An invalid TTL.')
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        # The method name, the uuid, and the expiry of each request in the
+        # order they were made.
+        self.__entries: OrderedDict[int, Tuple[str, str, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __expire(self, now: float) -> None:
+        while len(self.__entries) > 0:
+            number, (_, _, expiry) = next(iter(self.__entries.items()))
+            if expiry > now:
+                break
+            del self.__entries[number]
+
+    # Records a request. Returns the method name and the uuid of the request
+    # that had the same number and is still waiting for its response, if any.
+    def put(self, number: int, name: str, uuid: str) -> Optional[Tuple[str, str]]:
+        now = time.monotonic()
+        self.__expire(now)
+        prev_entry = self.__entries.pop(number, None)
+        while len(self.__entries) >= self.__max_entries:
+            self.__entries.popitem(last=False)
+        self.__entries[number] = (name, uuid, now + self.__ttl)
+        if prev_entry is None:
+            return None
+        return prev_entry[:2]
+
+    # Removes the request of the number, and returns its method name and uuid,
+    # or `None` if no request of the number is waiting for its response.
+    def pop(self, number: int) -> Optional[Tuple[str, str]]:
+        self.__expire(time.monotonic())
+        entry = self.__entries.pop(number, None)
+        if entry is None:
+            return None
+        return entry[:2]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import (Optional, Tuple,)
+
+
+# The status, the entity tag, the body, and the gzip-compressed body of a
+# response.
+CachedResponse = Tuple[HTTPStatus, Optional[str], Optional[bytes], Optional[bytes]]
+
+
+class ResponseCache(object):
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float) -> None:
+        self.__max_entries = max_entries
+        self.__max_bytes = max_bytes
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, Tuple[float, int, CachedResponse]] = OrderedDict()
+        self.__num_bytes = 0
+        self.__generation = 0
+
+    def __remove(self, key: str) -> None:
+        _, size, _ = self.__entries.pop(key)
+        self.__num_bytes -= size
+
+    def get_generation(self) -> int:
+        with self.__lock:
+            return self.__generation
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            expiry, _, response = entry
+            if expiry <= now:
+                self.__remove(key)
+                return None
+            self.__entries.move_to_end(key)
+            return response
+
+    # `generation` must be obtained by `get_generation` before the response is
+    # looked up, so that a response invalidated in the meantime is not cached.
+    def put(self, key: str, response: CachedResponse, generation: int) -> None:
+        _, _, body, gzip_body = response
+        size = len(key)
+        size += 0 if body is None else len(body)
+        size += 0 if gzip_body is None else len(gzip_body)
+        if self.__max_entries == 0 or size > self.__max_bytes:
+            return
+
+        with self.__lock:
+            if generation != self.__generation:
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.monotonic() + self.__ttl, size, response)
+            self.__num_bytes += size
+            while len(self.__entries) > self.__max_entries or self.__num_bytes > self.__max_bytes:
+                self.__remove(next(iter(self.__entries)))
+
+    def invalidate(self, key: str) -> None:
+        with self.__lock:
+            self.__generation += 1
+            if key in self.__entries:
+                self.__remove(key)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__generation += 1
+            self.__entries.clear()
+            self.__num_bytes = 0
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import json
+from typing import (List, Dict,)
+from kanachan_reviewer.redis import Redis
+
+
+# The reviews of the rounds of a game record that have been reviewed so far
+# are kept in a hash keyed by the round index, so that an analysis interrupted
+# halfway can resume from the last reviewed round. Checkpoints are also keyed
+# by the version of the reviews, so that those left by another model are never
+# mixed in.
+_KEY_PREFIX = 'review-checkpoints.'
+
+
+# Checkpoints outlive any crash-and-restart cycle, but do not pile up for game
+# records that are never analyzed again.
+_TTL = 86400
+
+
+def _get_key(version: str, uuid: str) -> str:
+    return f'{_KEY_PREFIX}{version}.{uuid}'
+
+
+def get_checkpoints(redis: Redis, version: str, uuids: List[str]) -> List[Dict[int, object]]:
+    pipeline = redis.pipeline(transaction=False)
+    for uuid in uuids:
+        pipeline.hgetall(_get_key(version, uuid))
+    results = pipeline.execute()
+
+    checkpoints: List[Dict[int, object]] = []
+    for result in results:
+        assert isinstance(result, dict)
+        checkpoint: Dict[int, object] = {}
+        for round_index, round_review in result.items():
+            assert isinstance(round_index, bytes)
+            assert isinstance(round_review, bytes)
+            checkpoint[int(round_index)] = json.loads(round_review.decode('UTF-8'))
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def put_checkpoint(
+        redis: Redis, version: str, uuid: str, round_index: int, round_review: object) -> None:
+    key = _get_key(version, uuid)
+    pipeline = redis.pipeline()
+    pipeline.hset(key, str(round_index), json.dumps(round_review, separators=(',', ':')))
+    pipeline.expire(key, _TTL)
+    pipeline.execute()
+
+
+def delete_checkpoints(redis: Redis, version: str, uuids: List[str]) -> None:
+    pipeline = redis.pipeline(transaction=False)
+    for uuid in uuids:
+        pipeline.delete(_get_key(version, uuid))
+    pipeline.execute()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+from typing import (Optional, Callable, Tuple, Iterator, List, Dict,)
+import torch
+from kanachan_reviewer.mahjongsoul_pb2 import ResGameRecord
+from kanachan_reviewer.decision_points import (
+    TILE_NAMES, MAX_NUM_CANDIDATES, DecisionPoint, Round, extract_decision_points,)
+
+
+# Bump this whenever the encoding of decision points or the layout of reviews
+# changes, so that the reviews produced before are recomputed.
+_REVIEW_FORMAT_VERSION = 2
+
+
+# Reviews game records with a kanachan model. The model must be a TorchScript
+# module called as `model(sparse, numeric, progression, candidates)` with the
+# features of a batch of decision points, and returning the score of each
+# candidate in the shape of `[batch size, MAX_NUM_CANDIDATES]`. The exact
+# shapes, types, and values of the features are given in `decision_points`.
+class ReviewEngine(object):
+    def __init__(self, model_path: str, batch_size: int, num_threads: int) -> None:
+        if batch_size < 1:
+            raise ValueError(f'{batch_size}: An invalid batch size.')
+        if num_threads < 1:
+            raise ValueError(f'{num_threads}: An invalid number of threads.')
+
+        digest = hashlib.sha256()
+        with open(model_path, 'rb') as fp:
+            while True:
+                chunk = fp.read(1048576)
+                if len(chunk) == 0:
+                    break
+                digest.update(chunk)
+        self.__version = f'{_REVIEW_FORMAT_VERSION}.{digest.hexdigest()[:16]}'
+
+        self.__model = torch.jit.load(model_path, map_location='cpu')
+        self.__model.eval()
+        self.__batch_size = batch_size
+        self.__num_threads = num_threads
+
+    # Identifies the reviews produced by this engine. It changes whenever
+    # either the model or the review format changes.
+    def get_version(self) -> str:
+        return self.__version
+
+    # Scores the candidates of decision points, running the model once per
+    # batch rather than once per decision point. The scores are yielded as soon
+    # as the batch they belong to is evaluated.
+    def __evaluate(self, decision_points: List[DecisionPoint]) -> Iterator[List[float]]:
+        # The number of threads is set on first use rather than on load, so
+        # that it takes effect in each of the processes forked after loading.
+        if torch.get_num_threads() != self.__num_threads:
+            torch.set_num_threads(self.__num_threads)
+
+        with torch.inference_mode():
+            for begin in range(0, len(decision_points), self.__batch_size):
+                batch = decision_points[begin:begin + self.__batch_size]
+                sparse = torch.tensor([dp.sparse for dp in batch], dtype=torch.int64)
+                numeric = torch.tensor([dp.numeric for dp in batch], dtype=torch.float32)
+                progression = torch.tensor([dp.progression for dp in batch], dtype=torch.int64)
+                candidates = torch.tensor([dp.candidates for dp in batch], dtype=torch.int64)
+                output: torch.Tensor = self.__model(sparse, numeric, progression, candidates)
+                if tuple(output.shape) != (len(batch), MAX_NUM_CANDIDATES):
+                    raise RuntimeError(f'{tuple(output.shape)}: An unexpected output shape.')
+                for dp, row in zip(batch, output.tolist()):
+                    yield row[:dp.num_candidates]
+
+    # Reviews game records. The decision points of all the game records are
+    # stacked together so that even short games fill up batches. The review of
+    # a game record whose decision points cannot be extracted, e.g., one that
+    # refers to its records by `data_url` instead of embedding them, is `None`.
+    #
+    # `finished_rounds` holds, for each game record, the reviews of the rounds
+    # that have already been reviewed, which are used as they are. Every other
+    # round is passed to `on_round_reviewed` together with the index of the
+    # game record and that of the round as soon as it is reviewed, so that the
+    # caller can checkpoint it.
+    def review(
+            self, game_records: List[ResGameRecord],
+            finished_rounds: Optional[List[Dict[int, object]]]=None,
+            on_round_reviewed: Optional[Callable[[int, int, object], None]]=None
+    ) -> List[Optional[object]]:
+        if finished_rounds is None:
+            finished_rounds = [{} for _ in game_records]
+        if len(finished_rounds) != len(game_records):
+            raise ValueError('The number of finished rounds does not match.')
+
+        games: List[List[Round]] = []
+        round_reviews: List[Dict[int, object]] = []
+        pending_decision_points: List[Tuple[int, DecisionPoint]] = []
+        num_pending_decision_points: List[List[int]] = []
+        failed: List[bool] = []
+        for i, game_record in enumerate(game_records):
+            try:
+                rounds, decision_points = extract_decision_points(game_record)
+                failed.append(False)
+            except ValueError:
+                uuid = game_record.head.uuid # pylint: disable=no-member
+                logging.exception('%s: Failed to extract decision points.', uuid)
+                rounds, decision_points = ([], [])
+                failed.append(True)
+            games.append(rounds)
+            round_reviews.append(
+                {j: review for j, review in finished_rounds[i].items() if j < len(rounds)})
+            counts = [0] * len(rounds)
+            for dp in decision_points:
+                if dp.round_index not in round_reviews[i]:
+                    pending_decision_points.append((i, dp))
+                    counts[dp.round_index] += 1
+            num_pending_decision_points.append(counts)
+
+        decisions: Dict[Tuple[int, int], List[Dict[str, object]]] = {}
+
+        def complete_round(i: int, j: int) -> None:
+            chang, ju, ben = games[i][j]
+            review = {
+                'chang': chang,
+                'ju': ju,
+                'ben': ben,
+                'decisions': decisions.pop((i, j), [])
+            }
+            round_reviews[i][j] = review
+            if on_round_reviewed is not None:
+                on_round_reviewed(i, j, review)
+
+        # Rounds without any decision point to review are complete as they are.
+        for i, counts in enumerate(num_pending_decision_points):
+            for j, count in enumerate(counts):
+                if count == 0 and j not in round_reviews[i]:
+                    complete_round(i, j)
+
+        scores = self.__evaluate([dp for _, dp in pending_decision_points])
+        for (i, dp), dp_scores in zip(pending_decision_points, scores):
+            candidates = dp.candidates[:dp.num_candidates]
+            best = candidates[max(range(len(dp_scores)), key=dp_scores.__getitem__)]
+            decisions.setdefault((i, dp.round_index), []).append({
+                'seat': dp.seat,
+                'actual': TILE_NAMES[dp.actual],
+                'candidates': [TILE_NAMES[c] for c in candidates],
+                'scores': dp_scores,
+                'best': TILE_NAMES[best]
+            })
+            num_pending_decision_points[i][dp.round_index] -= 1
+            if num_pending_decision_points[i][dp.round_index] == 0:
+                complete_round(i, dp.round_index)
+
+        reviews: List[Optional[object]] = []
+        for i, rounds in enumerate(games):
+            if failed[i]:
+                reviews.append(None)
+                continue
+            reviews.append({'rounds': [round_reviews[i][j] for j in range(len(rounds))]})
+
+        return reviews
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import datetime
+import gzip
+import json
+from types import NoneType
+from typing import (Optional, Union, Tuple, List, Dict,)
+from kanachan_reviewer.redis import Redis
+from kanachan_reviewer.async_redis import AsyncRedis
+
+
+# A review is stored across the following hashes keyed by uuid. The `reviews`
+# hash holds compact metadata such as the error code and the timestamp, and
+# its presence marks the review as available. The response body is serialized
+# once when the review is written, so that it can be served as is.
+_METADATA_KEY = 'reviews'
+_BODY_KEY = 'review-bodies'
+_GZIP_BODY_KEY = 'review-bodies.gzip'
+
+
+# The metadata, the body, and the gzip-compressed body of a review.
+StoredReview = Tuple[Dict[str, object], Optional[bytes], Optional[bytes]]
+
+
+_NOTIFICATION_CHANNEL_PREFIX = 'reviews.'
+
+
+NOTIFICATION_CHANNEL_PATTERN = f'{_NOTIFICATION_CHANNEL_PREFIX}*'
+
+
+def get_notification_channel(uuid: str) -> str:
+    return f'{_NOTIFICATION_CHANNEL_PREFIX}{uuid}'
+
+
+def get_uuid_from_notification_channel(channel: str) -> str:
+    if not channel.startswith(_NOTIFICATION_CHANNEL_PREFIX):
+        raise ValueError(f'{channel}: An invalid notification channel.')
+    return channel[len(_NOTIFICATION_CHANNEL_PREFIX):]
+
+
+# The error code of a game record that cannot be reviewed, e.g., one that
+# refers to its records by `data_url` instead of embedding them. The error codes
+# of Mahjong Soul are all positive.
+UNSUPPORTED_ERROR_CODE = -1
+
+
+# Marks the review of a uuid as being worked on, so that the requests for the
+# same uuid made in the meantime attach to the first one. The mark is removed
+# once the review is written or the work fails.
+def get_in_flight_key(uuid: str) -> str:
+    return f'game-record-requests.in-flight.{uuid}'
+
+
+# A uuid, an error code, and a review to write. The review is `None` if the
+# error code is not zero.
+ReviewToPut = Tuple[str, int, Optional[object]]
+
+
+# Writes the metadata of a review, and then its body unless the metadata has
+# been left as it is. Thus, the body is never replaced under the metadata, and
+# hence the timestamp, of another write.
+#
+# KEYS: the metadata, the body, and the gzip-compressed body hashes.
+# ARGV: the uuid, the metadata, whether to overwrite (`1` or `0`), and the body
+# and the gzip-compressed body, both of which are omitted if there is no body.
+_PUT_REVIEW_SCRIPT = """
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+elseif redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+if #ARGV >= 5 then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[5])
+else
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+
+# Writes reviews in one round trip and notifies the subscribers of them. Unless
+# `overwrite` is true, existing reviews are left as they are. `version`
+# identifies the analyzer and the model that produced the reviews, so that
+# stale reviews can be told apart when either of them changes. Returns whether
+# each review has been written.
+def put_reviews(
+        redis: Redis, reviews: List[ReviewToPut], *, overwrite: bool,
+        version: Optional[str]=None) -> List[bool]:
+    if len(reviews) == 0:
+        return []
+
+    timestamp = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+
+    pipeline = redis.pipeline()
+    metadata_jsons: List[str] = []
+    for uuid, error_code, review in reviews:
+        metadata: Dict[str, object] = {
+            'error_code': error_code,
+            'timestamp': timestamp
+        }
+        if version is not None:
+            metadata['version'] = version
+        metadata_json = json.dumps(metadata, separators=(',', ':'))
+        metadata_jsons.append(metadata_json)
+
+        args: List[Union[str, bytes]] = [uuid, metadata_json, '1' if overwrite else '0']
+        if review is not None:
+            body = json.dumps(review, separators=(',', ':')).encode('UTF-8')
+            args.extend((body, gzip.compress(body, mtime=0)))
+        pipeline.eval(_PUT_REVIEW_SCRIPT, (_METADATA_KEY, _BODY_KEY, _GZIP_BODY_KEY), args)
+    results = pipeline.execute()
+
+    written = [result == 1 for result in results]
+
+    # The message carries the metadata just written, so that subscribers do
+    # not have to look it up again.
+    pipeline = redis.pipeline(transaction=False)
+    for (uuid, _, _), metadata_json, is_written in zip(reviews, metadata_jsons, written):
+        pipeline.delete(get_in_flight_key(uuid))
+        if is_written:
+            pipeline.publish(get_notification_channel(uuid), metadata_json)
+    pipeline.execute()
+
+    return written
+
+
+def put_review(
+        redis: Redis, uuid: str, error_code: int, review: Optional[object], *,
+        overwrite: bool, version: Optional[str]=None) -> bool:
+    return put_reviews(
+        redis, [(uuid, error_code, review)], overwrite=overwrite, version=version)[0]
+
+
+def _decode_metadata(metadata_encoded: bytes) -> Dict[str, object]:
+    metadata: Dict[str, object] = json.loads(metadata_encoded.decode('UTF-8'))
+    return metadata
+
+
+# Returns the metadata of reviews without their bodies.
+def get_review_metadata(redis: Redis, uuids: List[str]) -> List[Optional[Dict[str, object]]]:
+    pipeline = redis.pipeline(transaction=False)
+    for uuid in uuids:
+        pipeline.hget(_METADATA_KEY, uuid)
+    results: List[Optional[Dict[str, object]]] = []
+    for metadata_encoded in pipeline.execute():
+        if metadata_encoded is None:
+            results.append(None)
+            continue
+        assert isinstance(metadata_encoded, bytes)
+        results.append(_decode_metadata(metadata_encoded))
+    return results
+
+
+# Iterates over the metadata of all the reviews, a chunk at a time. Returns the
+# cursor to pass to resume the iteration, which is zero at the end.
+def scan_review_metadata(
+        redis: Redis, cursor: int, count: int) -> Tuple[int, Dict[str, Dict[str, object]]]:
+    cursor, results = redis.hscan(_METADATA_KEY, cursor, count)
+    metadata = {uuid: _decode_metadata(encoded) for uuid, encoded in results.items()}
+    return (cursor, metadata)
+
+
+def _decode_stored_review(
+        metadata_encoded: object, body: object, gzip_body: object) -> Optional[StoredReview]:
+    if metadata_encoded is None:
+        return None
+    assert isinstance(metadata_encoded, bytes)
+    assert isinstance(body, (bytes, NoneType))
+    assert isinstance(gzip_body, (bytes, NoneType))
+
+    metadata = _decode_metadata(metadata_encoded)
+    if 'review' in metadata:
+        # A review stored in the former layout, where the metadata embeds the
+        # review itself.
+        review = metadata.pop('review')
+        body = json.dumps(review, separators=(',', ':')).encode('UTF-8')
+        gzip_body = None
+
+    return (metadata, body, gzip_body)
+
+
+async def async_get_encoded_review_metadata(redis: AsyncRedis, uuid: str) -> Optional[bytes]:
+    return await redis.hget(_METADATA_KEY, uuid)
+
+
+def get_review(redis: Redis, uuid: str) -> Optional[StoredReview]:
+    pipeline = redis.pipeline()
+    pipeline.hget(_METADATA_KEY, uuid)
+    pipeline.hget(_BODY_KEY, uuid)
+    pipeline.hget(_GZIP_BODY_KEY, uuid)
+    metadata_encoded, body, gzip_body = pipeline.execute()
+    return _decode_stored_review(metadata_encoded, body, gzip_body)
+
+
+async def async_get_review(redis: AsyncRedis, uuid: str) -> Optional[StoredReview]:
+    pipeline = redis.pipeline()
+    pipeline.hget(_METADATA_KEY, uuid)
+    pipeline.hget(_BODY_KEY, uuid)
+    pipeline.hget(_GZIP_BODY_KEY, uuid)
+    metadata_encoded, body, gzip_body = await pipeline.execute()
+    return _decode_stored_review(metadata_encoded, body, gzip_body)
@@ -18,5 +18,12 @@ python3 launch-and-close-chrome.py
 # Copy the mitmproxy's certificate to the certificate store created there.
 certutil -A -n mitmproxy -t 'TCu,Cu,Tu' -i ~/mitmproxy-ca-cert.crt -d "sql:$HOME/.pki/nssdb"
 
-# Launch fetcher.
-python3 fetcher.py
+# Launch fetchers. All of them share the `mitmdump` launched above, which
+# tells their WebSocket connections apart.
+num_fetchers="${KANACHAN_REVIEWER_FETCHERS:-1}"
+for (( i = 0; i < num_fetchers; ++i )); do
+  python3 fetcher.py &
+done
+
+# Exit as soon as any of the fetchers exits.
+wait -n
@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 
-import re
 import datetime
+import functools
 import logging
+import queue
+import threading
+from pathlib import Path
 from logging.handlers import RotatingFileHandler
-import json
-from typing import (NoReturn, Dict, Union,)
+from typing import (NoReturn, Optional, Callable, Dict,)
 import wsproto.frame_protocol
 from mitmproxy.http import HTTPFlow
 from kanachan_reviewer.config import get_config
 from kanachan_reviewer.redis import Redis
-from kanachan_reviewer.redis_log_handler import RedisLogHandler
-from kanachan_reviewer.mahjongsoul_pb2 import Wrapper, ReqGameRecord, ResGameRecord
+from kanachan_reviewer.redis_log_handler import BufferedRedisLogHandler
+from kanachan_reviewer.reviews import put_review
+from kanachan_reviewer.archive import Archive
+from kanachan_reviewer.request_table import RequestTable
+from kanachan_reviewer.mahjongsoul_pb2 import Wrapper, ReqGameRecord
+from kanachan_reviewer.game_record import (decode_game_record, verify_protobuf_implementation,)
 
 
 _CONFIG = get_config()
@@ -24,6 +30,11 @@ assert isinstance(_REDIS_PORT, int)
 _REDIS = Redis(_REDIS_HOST, _REDIS_PORT)
 
 
+_ARCHIVE_PATH = _CONFIG['archive']['path']
+assert isinstance(_ARCHIVE_PATH, str)
+_ARCHIVE = Archive(Path(_ARCHIVE_PATH))
+
+
 _LOGGER = logging.Logger('sniffer')
 if 'sniffer' in _CONFIG:
     _LOG_CONFIG = _CONFIG['sniffer']['logging']
@@ -48,15 +59,24 @@ if 'sniffer' in _CONFIG:
         assert isinstance(_REDIS_LOG_KEY, str)
         _REDIS_LOG_MAX_ENTRIES = _REDIS_LOG_CONFIG['max_entries']
         assert isinstance(_REDIS_LOG_MAX_ENTRIES, int)
-        _REDIS_LOG_HANDLER = RedisLogHandler(_REDIS, _REDIS_LOG_KEY, _REDIS_LOG_MAX_ENTRIES)
+        _REDIS_LOG_HANDLER = BufferedRedisLogHandler(
+            _REDIS, _REDIS_LOG_KEY, _REDIS_LOG_MAX_ENTRIES)
         _LOGGER.addHandler(_REDIS_LOG_HANDLER)
     _LOG_LEVEL = _LOG_CONFIG['level']
     assert isinstance(_LOG_LEVEL, str)
     _LOGGER.setLevel(_LOG_LEVEL)
 
 
-_WebsocketMessage = Dict[str, Union[str, bytes]]
-_WEBSOCKET_MESSAGE_QUEUE: Dict[int, _WebsocketMessage] = {}
+verify_protobuf_implementation()
+
+
+# The requests waiting for their responses, tracked per WebSocket connection
+# so that responses are never matched with requests made over another
+# connection, e.g., those of another tab, another fetcher sharing the proxy, or
+# those before a reconnect. The table of a connection is dropped when it ends.
+_REQUEST_TABLE_MAX_ENTRIES = 64
+_REQUEST_TABLE_TTL = 60.0
+_REQUEST_TABLES: Dict[str, RequestTable] = {}
 
 
 def _logging_info(message: str, *args: object) -> None:
@@ -84,6 +104,116 @@ def _raise_error(message: str) -> NoReturn:
     raise RuntimeError(message)
 
 
+# The fetcher marks the fetches for bulk requests with these keys.
+_BULK_FETCH_KEY_PREFIX = 'game-record-fetches.bulk.'
+
+
+# The time for which a fetch completion is kept for the fetcher to pop.
+_FETCHED_NOTIFICATION_TTL = 60
+
+
+# Marks a game record as fetched. Unless `notify` is false, also wakes up the
+# fetcher waiting for it, which must be done exactly once per fetch, i.e., on
+# the response to `.lq.Lobby.fetchGameRecord`, since a leftover notification
+# would complete the next fetch of the same game record before it arrives.
+def _mark_fetched(uuid: str, notify: bool=True) -> None:
+    timestamp = str(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
+    pipeline = _REDIS.pipeline(transaction=False)
+    pipeline.hsetnx('game-record-fetched', uuid, timestamp)
+    if notify:
+        fetched_key = f'game-record-fetched.{uuid}'
+        pipeline.rpush(fetched_key, timestamp)
+        pipeline.expire(fetched_key, _FETCHED_NOTIFICATION_TTL)
+    pipeline.execute()
+
+
+def _store_game_record(content: bytes, requested_uuid: str) -> None:
+    try:
+        game_record = decode_game_record(content)
+    except RuntimeError:
+        _logging_error('An invalid message.')
+        return
+    error_code = game_record.error.code # pylint: disable=no-member
+    if error_code != 0:
+        # A bulk fetch is usually a re-review of a game record that has already
+        # been reviewed, so its error must not overwrite a valid review.
+        bulk = _REDIS.getdel(f'{_BULK_FETCH_KEY_PREFIX}{requested_uuid}') is not None
+        put_review(_REDIS, requested_uuid, error_code, None, overwrite=not bulk)
+        _mark_fetched(requested_uuid)
+        return
+    uuid = game_record.head.uuid # pylint: disable=no-member
+
+    # Keep the game record in the archive, and queue only its uuid to the lane
+    # of the analyzer that matches that of the request.
+    _ARCHIVE.append(uuid, game_record.SerializeToString())
+    if _REDIS.getdel(f'{_BULK_FETCH_KEY_PREFIX}{uuid}') is not None:
+        _REDIS.rpush('game-records.bulk', uuid)
+    else:
+        _REDIS.rpush('game-records', uuid)
+    _mark_fetched(uuid)
+    _logging_info('%s: Sniffered.', uuid)
+
+
+# Decoding and storing game records, which involves Redis and the archive, is
+# handed off to a writer thread through a bounded queue, so that the hooks,
+# which run on the event loop of mitmproxy, never wait for them and proxying
+# does not slow down with Redis. If the writer falls behind so far that the
+# queue fills up, messages are dropped, and the fetches time out.
+_HAND_OFF_QUEUE_SIZE = 256
+_HAND_OFF_QUEUE: 'queue.Queue[Optional[Callable[[], None]]]' = queue.Queue(_HAND_OFF_QUEUE_SIZE)
+
+
+def _write() -> None:
+    while True:
+        task = _HAND_OFF_QUEUE.get()
+        if task is None:
+            return
+        try:
+            task()
+        except: # pylint: disable=bare-except
+            _logging_exception('Abort with an exception.')
+
+
+_WRITER = threading.Thread(target=_write, daemon=True)
+_WRITER.start()
+
+
+def _hand_off(function: Callable[..., None], *args: object) -> None:
+    try:
+        _HAND_OFF_QUEUE.put_nowait(functools.partial(function, *args))
+    except queue.Full:
+        _logging_error('The hand-off queue is full. Dropped a message.')
+
+
+# The methods whose requests and responses are handled. Frames of any other
+# method are dropped as soon as the name of the method is read.
+_METHOD_NAMES = frozenset((b'.lq.Lobby.fetchGameRecord', b'.lq.Lobby.readGameRecord',))
+
+
+# Reads the `name` field of the `Wrapper` message that starts at `offset`,
+# without parsing the rest of the message. Returns `None` if the message does
+# not start with the field.
+def _get_name(content: bytes, offset: int) -> Optional[bytes]:
+    # The tag of the field number 1 of the wire type 2 (length-delimited).
+    if offset >= len(content) or content[offset] != 0x0A:
+        return None
+    offset += 1
+    length = 0
+    shift = 0
+    while True:
+        if offset >= len(content) or shift > 28:
+            return None
+        byte = content[offset]
+        offset += 1
+        length |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    if offset + length > len(content):
+        return None
+    return content[offset:offset + length]
+
+
 def _websocket_message(flow: HTTPFlow) -> None:
     if flow.request.url not in ('https://mjjpgs.mahjongsoul.com:9663/',):
         return
@@ -103,115 +233,74 @@ def _websocket_message(flow: HTTPFlow) -> None:
         direction = 'inbound'
 
     content = message.content
-
-    match = re.search(b'^(?:\x01|\x02..)\n.(.*?)\x12', content, flags=re.DOTALL)
-    if match is not None:
-        type_ = content[0]
-        assert type_ in [1, 2]
-
-        number = None
-        if type_ == 2:
-            number = int.from_bytes(content[1:3], byteorder='little')
-
-        name = match.group(1).decode('UTF-8')
-
-        if type_ == 2:
-            # Handle a request message that expects a response message.
-            # Enqueue the message until the corresponding responce message arrives.
-            assert isinstance(number, int)
-            if number in _WEBSOCKET_MESSAGE_QUEUE:
-                prev_request = _WEBSOCKET_MESSAGE_QUEUE[number]
-                _logging_warning(
-'''There is not any response message for the following WebSocket request message:
-  direction: %s
-  content: %s''', prev_request['direction'], prev_request['request'])
-
-            _WEBSOCKET_MESSAGE_QUEUE[number] = {
-                'direction': direction,
-                'name': name,
-                'request': content
-            }
-
-        return
-
-    # Handle a response message.
-    # Search the corresponding request message in the queue.
-    match = re.search(b'^\x03..\n\x00\x12', content, flags=re.DOTALL)
-    if match is None:
+    if len(content) < 3:
         _raise_error(
             f'''An unknown WebSocket message:
   direction: {direction}
-  content: {content}''')
+  content: {content!r}''')
+    type_ = content[0]
 
-    number = int.from_bytes(content[1:3], byteorder='little')
-    if number not in _WEBSOCKET_MESSAGE_QUEUE:
-        _raise_error(
-            f'''An WebSocket response message that does not match to any request message:
-  direction: {direction}
-  content: {content}''')
-
-    request_direction = _WEBSOCKET_MESSAGE_QUEUE[number]['direction']
-    name = _WEBSOCKET_MESSAGE_QUEUE[number]['name']
-    request_binary = _WEBSOCKET_MESSAGE_QUEUE[number]['request']
-    assert isinstance(request_binary, bytes)
-    del _WEBSOCKET_MESSAGE_QUEUE[number]
-
-    if request_direction == 'inbound':
-        if direction == 'inbound':
-            _raise_error('Both request and response WebSocket messages are inbound.')
-        assert direction == 'outbound'
-    else:
-        assert request_direction == 'outbound'
-        if direction == 'outbound':
-            _raise_error('Both request and response WebSocket messages are outbound.')
-        assert direction == 'inbound'
+    if type_ == 1:
+        # A notification, which never carries a game record.
+        return
 
-    if request_direction == 'outbound' and name == '.lq.Lobby.fetchGameRecord':
-        wrapper = Wrapper()
-        wrapper.ParseFromString(content[3:])
-        if wrapper.name != '': # pylint: disable=no-member
-            _logging_error('An invalid message.')
+    if type_ == 2:
+        # Handle a request message that expects a response message. Only the
+        # requests for game records made by the client are of interest, and
+        # the others are dropped without being parsed any further.
+        if direction != 'outbound':
             return
-
-        game_record = ResGameRecord()
-        game_record.ParseFromString(wrapper.data) # pylint: disable=no-member
-        error_code = game_record.error.code # pylint: disable=no-member
-        if error_code != 0:
-            wrapper.ParseFromString(request_binary[3:])
-            assert wrapper.name == name # pylint: disable=no-member
-
-            request = ReqGameRecord()
-            request.ParseFromString(wrapper.data) # pylint: disable=no-member
-            uuid = request.game_uuid # pylint: disable=no-member
-
-            timestamp = str(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-            review = {
-                'error_code': error_code,
-                'timestamp': timestamp
-            }
-            review_json = json.dumps(review, separators=(',', ':'))
-            _REDIS.hset('reviews', uuid, review_json)
-
+        name = _get_name(content, 3)
+        if name is None or name not in _METHOD_NAMES:
             return
-        uuid = game_record.head.uuid # pylint: disable=no-member
-
-        _REDIS.rpush('game-records', content)
-        _logging_info('%s: Sniffered.', uuid)
-
-        return
 
-    if request_direction == 'outbound' and name == '.lq.Lobby.readGameRecord':
         wrapper = Wrapper()
-        wrapper.ParseFromString(request_binary[3:])
-        assert wrapper.name == '.lq.Lobby.readGameRecord' # pylint: disable=no-member
-
+        wrapper.ParseFromString(content[3:])
         request = ReqGameRecord()
         request.ParseFromString(wrapper.data) # pylint: disable=no-member
         uuid = request.game_uuid # pylint: disable=no-member
 
-        timestamp = str(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
-        _REDIS.hset('game-record-fetched', uuid, timestamp)
+        # Keep the method name and the uuid until the corresponding responce
+        # message arrives.
+        number = int.from_bytes(content[1:3], byteorder='little')
+        if flow.id not in _REQUEST_TABLES:
+            _REQUEST_TABLES[flow.id] = RequestTable(
+                _REQUEST_TABLE_MAX_ENTRIES, _REQUEST_TABLE_TTL)
+        prev_request = _REQUEST_TABLES[flow.id].put(number, name.decode('UTF-8'), uuid)
+        if prev_request is not None:
+            _logging_warning(
+                'There is not any response message for the request %s of %s.',
+                prev_request[0], prev_request[1])
+
+        return
+
+    if type_ != 3:
+        _raise_error(
+            f'''An unknown WebSocket message:
+  direction: {direction}
+  content: {content!r}''')
+
+    # Handle a response message.
+    # Search the corresponding request message in the table. Responses to the
+    # requests that have been dropped are not found there.
+    if direction != 'inbound':
+        return
+    request_table = _REQUEST_TABLES.get(flow.id)
+    if request_table is None:
+        return
+    number = int.from_bytes(content[1:3], byteorder='little')
+    pending_request = request_table.pop(number)
+    if pending_request is None:
+        return
+    name, uuid = pending_request
+
+    if name == '.lq.Lobby.fetchGameRecord':
+        _hand_off(_store_game_record, content, uuid)
+        return
 
+    if name == '.lq.Lobby.readGameRecord':
+        # The paipu page reads the game record before fetching it.
+        _hand_off(_mark_fetched, uuid, False)
         return
 
 
@@ -220,3 +309,18 @@ def websocket_message(flow: HTTPFlow) -> None:
         _websocket_message(flow)
     except: # pylint: disable=bare-except
         _logging_exception('Abort with an exception.')
+
+
+# Called by mitmproxy when a WebSocket connection is closed. Requests made over
+# the connection never get their responses any more.
+def websocket_end(flow: HTTPFlow) -> None:
+    request_table = _REQUEST_TABLES.pop(flow.id, None)
+    if request_table is not None and len(request_table) > 0:
+        _logging_warning(
+            '%s: %d requests have not got their responses.', flow.id, len(request_table))
+
+
+# Called by mitmproxy on shutdown. Writes out what has been handed off.
+def done() -> None:
+    _HAND_OFF_QUEUE.put(None)
+    _WRITER.join(10.0)